@@ -0,0 +1,586 @@
+"""
+Benchmark the export pipeline against a local PostgreSQL.
+
+The harness starts a throwaway PostgreSQL (a `pg_ctl` cluster in a temporary
+directory, or a Docker container), generates a synthetic table, and runs the
+full `lambda_handler` pipeline on it in every extraction mode, writing either
+to local storage or to an in-process S3 stand-in (moto). Each case runs in its
+own process so that its peak memory is measured in isolation, and so that
+every run is a cold start: the import time of the entry module and the heavy
+dependencies each mode ends up loading are reported along with the export
+time. In S3 cases boto3 is already loaded by moto before the import.
+
+Memory is reported as the growth of the peak RSS during the export, and as
+its ratio to the result size, the Arrow in-memory size of the exported rows.
+A ratio close to 1 means the export held about one copy of the result at its
+peak; batch modes stay far below it on large results.
+
+Results are written as JSON, so runs of two commits can be compared:
+
+    python benchmark.py --rows 1000000 --width 20 --output before.json
+    python benchmark.py --rows 1000000 --width 20 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# SQL expression generating each column type of the synthetic table, from the
+# row number `i`.
+COLUMN_TYPES = {
+    "int": "(random() * 1000000)::int",
+    "bigint": "(random() * 1000000000000)::bigint",
+    "float": "random() * 1000",
+    "numeric": "round((random() * 1000000)::numeric, 2)::numeric(12, 2)",
+    "text": "md5(random()::text)",
+    "category": "(ARRAY['red', 'green', 'blue', 'yellow'])[1 + (random() * 3)::int]",
+    "bool": "random() < 0.5",
+    "date": "DATE '2020-01-01' + (random() * 1500)::int",
+    "timestamp": "TIMESTAMP '2020-01-01' + random() * INTERVAL '1500 days'",
+    "timestamptz": "TIMESTAMPTZ '2020-01-01' + random() * INTERVAL '1500 days'",
+    "jsonb": "jsonb_build_object('id', i, 'tag', md5(i::text))",
+    "uuid": "md5(random()::text)::uuid",
+}
+DEFAULT_TYPE_MIX = "int,bigint,float,numeric,text,category,bool,date,timestamptz,jsonb"
+MODES = ("pandas", "stream", "copy", "async")
+WRITERS = ("local", "s3")
+DB_NAME = "postgres"
+DB_USER = "postgres"
+DB_PASSWORD = "benchmark"
+S3_BUCKET = "benchmark"
+# Optional dependencies that the entry module imports lazily, reported per case.
+HEAVY_MODULES = ("pandas", "awswrangler", "sqlalchemy", "boto3", "pyarrow.dataset")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=100000, help="Rows per table.")
+    parser.add_argument(
+        "--width", type=int, default=10, help="Number of columns besides the id."
+    )
+    parser.add_argument(
+        "--types",
+        default=DEFAULT_TYPE_MIX,
+        help=f"Comma-separated column types, cycled over the width. "
+        f"Available: {', '.join(COLUMN_TYPES)}.",
+    )
+    parser.add_argument(
+        "--null-ratio", type=float, default=0.1, help="Share of NULL values."
+    )
+    parser.add_argument(
+        "--modes", default=",".join(MODES), help="Extraction modes to run."
+    )
+    parser.add_argument(
+        "--writers", default=",".join(WRITERS), help="Output targets to run."
+    )
+    parser.add_argument(
+        "--options",
+        default="{}",
+        help="JSON export options applied to every case, e.g. "
+        '\'{"parquet_compression": "zstd"}\'.',
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case.")
+    parser.add_argument(
+        "--postgres",
+        choices=("auto", "pg_ctl", "docker", "dsn"),
+        default="auto",
+        help="How to get a database: a temporary pg_ctl cluster, a Docker "
+        "container, or an existing server given with --dsn.",
+    )
+    parser.add_argument(
+        "--dsn",
+        default=None,
+        help="libpq connection string of an existing server for --postgres dsn.",
+    )
+    parser.add_argument(
+        "--docker-image", default="postgres:16", help="Image for --postgres docker."
+    )
+    parser.add_argument(
+        "--output", default=None, help="JSON results file (default: stdout only)."
+    )
+    parser.add_argument(
+        "--compare", default=None, help="Previous JSON results to compare with."
+    )
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_postgres(params, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(**params).close()
+            return
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+class PgCtlCluster:
+    """A throwaway PostgreSQL cluster in a temporary directory."""
+
+    def __init__(self):
+        self.bindir = self._find_bindir()
+        self.directory = tempfile.mkdtemp(prefix="postgres2parquet-bench-")
+        self.port = free_port()
+        self.params = {
+            "dbname": DB_NAME,
+            "user": DB_USER,
+            "password": DB_PASSWORD,
+            "host": "127.0.0.1",
+            "port": self.port,
+        }
+
+    @staticmethod
+    def _find_bindir():
+        if shutil.which("pg_ctl") and shutil.which("initdb"):
+            return os.path.dirname(shutil.which("pg_ctl"))
+        if shutil.which("pg_config"):
+            bindir = subprocess.check_output(["pg_config", "--bindir"], text=True)
+            if os.path.exists(os.path.join(bindir.strip(), "pg_ctl")):
+                return bindir.strip()
+        raise RuntimeError("pg_ctl and initdb were not found")
+
+    def __enter__(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [
+                os.path.join(self.bindir, "initdb"),
+                "-D",
+                data,
+                "-U",
+                DB_USER,
+                "-A",
+                "trust",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [
+                os.path.join(self.bindir, "pg_ctl"),
+                "-D",
+                data,
+                "-l",
+                os.path.join(self.directory, "postgres.log"),
+                "-o",
+                f"-p {self.port} -c listen_addresses=127.0.0.1 "
+                f"-k {self.directory} -c fsync=off",
+                "-w",
+                "start",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        wait_for_postgres(self.params)
+        return self.params
+
+    def __exit__(self, *exc_info):
+        subprocess.run(
+            [
+                os.path.join(self.bindir, "pg_ctl"),
+                "-D",
+                os.path.join(self.directory, "data"),
+                "-m",
+                "immediate",
+                "stop",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class DockerPostgres:
+    """A throwaway PostgreSQL container."""
+
+    def __init__(self, image):
+        if not shutil.which("docker"):
+            raise RuntimeError("docker was not found")
+        self.image = image
+        self.port = free_port()
+        self.container = None
+        self.params = {
+            "dbname": DB_NAME,
+            "user": DB_USER,
+            "password": DB_PASSWORD,
+            "host": "127.0.0.1",
+            "port": self.port,
+        }
+
+    def __enter__(self):
+        self.container = subprocess.check_output(
+            [
+                "docker",
+                "run",
+                "-d",
+                "--rm",
+                "-e",
+                f"POSTGRES_PASSWORD={DB_PASSWORD}",
+                "-p",
+                f"127.0.0.1:{self.port}:5432",
+                self.image,
+            ],
+            text=True,
+        ).strip()
+        wait_for_postgres(self.params, timeout=120)
+        return self.params
+
+    def __exit__(self, *exc_info):
+        subprocess.run(["docker", "stop", self.container], stdout=subprocess.DEVNULL)
+
+
+class ExistingPostgres:
+    """A server given by a libpq connection string."""
+
+    def __init__(self, dsn):
+        if not dsn:
+            raise RuntimeError("--dsn is required with --postgres dsn")
+        self.params = psycopg2.extensions.parse_dsn(dsn)
+
+    def __enter__(self):
+        wait_for_postgres(self.params, timeout=5)
+        return self.params
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def start_postgres(args):
+    if args.postgres == "dsn":
+        return ExistingPostgres(args.dsn)
+    if args.postgres == "docker":
+        return DockerPostgres(args.docker_image)
+    if args.postgres == "pg_ctl":
+        return PgCtlCluster()
+    try:
+        return PgCtlCluster()
+    except RuntimeError:
+        return DockerPostgres(args.docker_image)
+
+
+def table_sql(table, rows, width, types, null_ratio):
+    """Build the statement creating a synthetic table of `rows` rows."""
+    columns = ["i::bigint AS id"]
+    for index in range(width):
+        column_type = types[index % len(types)]
+        expression = COLUMN_TYPES[column_type]
+        if null_ratio > 0:
+            expression = (
+                f"CASE WHEN random() < {null_ratio} THEN NULL ELSE {expression} END"
+            )
+        columns.append(f"{expression} AS {column_type}_{index}")
+    return (
+        f"DROP TABLE IF EXISTS {table};\n"
+        "SELECT setseed(0.42);\n"
+        f"CREATE TABLE {table} AS SELECT {', '.join(columns)} "
+        f"FROM generate_series(1, {rows}) AS i;\n"
+        f"ANALYZE {table};"
+    )
+
+
+def create_table(params, args, types):
+    table = f"bench_{args.width}_{args.rows}"
+    conn = psycopg2.connect(**params)
+    try:
+        with conn, conn.cursor() as curs:
+            curs.execute(
+                table_sql(table, args.rows, args.width, types, args.null_ratio)
+            )
+            curs.execute("SELECT pg_table_size(%s), version()", (table,))
+            table_bytes, version = curs.fetchone()
+    finally:
+        conn.close()
+    return table, table_bytes, version
+
+
+def run_case(case):
+    """
+    Run one export in this process and return its measurements.
+
+    Called in a child process, so that `ru_maxrss` is the peak of this case.
+    """
+    params = case["params"]
+    staging = case["writer"] == "local"
+    env_suffix = "STAGING" if staging else "PROD"
+    os.environ.update(
+        {
+            "ENVIRONMENT": "staging" if staging else "production",
+            f"DB_NAME_{env_suffix}": params["dbname"],
+            "DB_USER": params["user"],
+            f"DB_PASSWORD_{env_suffix}": params.get("password", ""),
+            f"DB_HOST_{env_suffix}": params.get("host", "localhost"),
+            f"DB_PORT_{env_suffix}": str(params.get("port", 5432)),
+            "FILE_NAME": "benchmark.parquet",
+            "LOCAL_PATH": case["directory"],
+            "S3_PATH": f"s3://{S3_BUCKET}/",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_ACCESS_KEY_ID": "benchmark",
+            "AWS_SECRET_ACCESS_KEY": "benchmark",
+        }
+    )
+    event = {
+        "jobs": [
+            {
+                "name": f"{case['mode']}-{case['writer']}",
+                "sql": f"SELECT * FROM {case['table']}",
+                "file_name": "benchmark.parquet",
+                "options": {"extract_mode": case["mode"], **case["options"]},
+            }
+        ]
+    }
+
+    if staging:
+        start = time.perf_counter()
+        import lambda_function
+
+        import_seconds = time.perf_counter() - start
+        baseline_rss_mb = peak_rss_mb()
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        seconds = time.perf_counter() - start
+        peak_mb = peak_rss_mb()
+        output_bytes = directory_size(case["directory"])
+        result_bytes = sum(
+            pq.read_table(os.path.join(root, name)).nbytes
+            for root, _, names in os.walk(case["directory"])
+            for name in names
+            if name.endswith(".parquet")
+        )
+    else:
+        import boto3
+        from moto import mock_aws
+
+        with mock_aws():
+            boto3.client("s3").create_bucket(Bucket=S3_BUCKET)
+            start = time.perf_counter()
+            import lambda_function
+
+            import_seconds = time.perf_counter() - start
+            baseline_rss_mb = peak_rss_mb()
+            start = time.perf_counter()
+            response = lambda_function.lambda_handler(event, None)
+            seconds = time.perf_counter() - start
+            peak_mb = peak_rss_mb()
+            s3 = boto3.client("s3")
+            objects = s3.list_objects_v2(Bucket=S3_BUCKET).get("Contents", [])
+            output_bytes = sum(item["Size"] for item in objects)
+            result_bytes = sum(
+                pq.read_table(
+                    pa.BufferReader(
+                        s3.get_object(Bucket=S3_BUCKET, Key=item["Key"])["Body"].read()
+                    )
+                ).nbytes
+                for item in objects
+                if item["Key"].endswith(".parquet")
+            )
+
+    body = json.loads(response["body"])
+    job = body["jobs"][0]
+    if job["status"] != "success":
+        raise RuntimeError(job["error"])
+    return {
+        "seconds": seconds,
+        "import_seconds": import_seconds,
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+        "rows": job["rows"],
+        "output_bytes": output_bytes,
+        "result_bytes": result_bytes,
+        "baseline_rss_mb": baseline_rss_mb,
+        "peak_rss_mb": peak_mb,
+        "stages": body.get("metrics", {}),
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def run_case_in_subprocess(case):
+    with tempfile.TemporaryDirectory() as directory:
+        case = {**case, "directory": directory}
+        result_file = os.path.join(directory, "result.json")
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            env={**os.environ, "BENCHMARK_RESULT_FILE": result_file},
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+        with open(result_file) as result:
+            return json.load(result)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_file):
+    with open(previous_file) as previous:
+        previous = {
+            (case["mode"], case["writer"]): case
+            for case in json.load(previous)["cases"]
+        }
+    print(f"\nCompared with {previous_file}:")
+    for case in results["cases"]:
+        before = previous.get((case["mode"], case["writer"]))
+        if before is None or "rows_per_s" not in case or "rows_per_s" not in before:
+            continue
+        change = case["rows_per_s"] / before["rows_per_s"] - 1
+        memory = case["peak_rss_mb"] - before["peak_rss_mb"]
+        ratio = ""
+        if before.get("peak_to_result") and case.get("peak_to_result"):
+            ratio = (
+                f"  peak/result {before['peak_to_result']:.2f}x -> "
+                f"{case['peak_to_result']:.2f}x"
+            )
+        print(
+            f"  {case['mode']:>6} -> {case['writer']:<5} "
+            f"rows/s {change:+.1%}  peak RSS {memory:+.1f} MB{ratio}"
+        )
+
+
+def main():
+    args = parse_args()
+    types = [column_type.strip() for column_type in args.types.split(",")]
+    unknown = set(types) - set(COLUMN_TYPES)
+    if unknown:
+        sys.exit(f"Unknown column types: {', '.join(sorted(unknown))}")
+    modes = [mode.strip() for mode in args.modes.split(",")]
+    writers = [writer.strip() for writer in args.writers.split(",")]
+    options = json.loads(args.options)
+
+    with start_postgres(args) as params:
+        print(f"Generating {args.rows} rows x {args.width + 1} columns...")
+        table, table_bytes, version = create_table(params, args, types)
+        results = {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "postgres": version,
+            "table": {
+                "rows": args.rows,
+                "width": args.width,
+                "types": types,
+                "null_ratio": args.null_ratio,
+                "bytes": table_bytes,
+            },
+            "options": options,
+            "cases": [],
+        }
+        for mode in modes:
+            for writer in writers:
+                case = {
+                    "params": params,
+                    "table": table,
+                    "mode": mode,
+                    "writer": writer,
+                    "options": options,
+                }
+                runs = []
+                try:
+                    for _ in range(args.repeat):
+                        runs.append(run_case_in_subprocess(case))
+                except RuntimeError as e:
+                    print(f"  {mode:>6} -> {writer:<5} failed: {e}")
+                    results["cases"].append(
+                        {"mode": mode, "writer": writer, "error": str(e)}
+                    )
+                    continue
+                best = min(runs, key=lambda run: run["seconds"])
+                seconds = best["seconds"]
+                export_rss_mb = max(
+                    run["peak_rss_mb"] - run["baseline_rss_mb"] for run in runs
+                )
+                result_mb = best["result_bytes"] / 1024 / 1024
+                results["cases"].append(
+                    {
+                        "mode": mode,
+                        "writer": writer,
+                        "rows": best["rows"],
+                        "seconds": round(seconds, 3),
+                        "rows_per_s": round(best["rows"] / seconds),
+                        "mb_per_s": round(table_bytes / seconds / 1024 / 1024, 2),
+                        "output_bytes": best["output_bytes"],
+                        "peak_rss_mb": round(
+                            max(run["peak_rss_mb"] for run in runs), 1
+                        ),
+                        "export_rss_mb": round(export_rss_mb, 1),
+                        "result_mb": round(result_mb, 1),
+                        "peak_to_result": (
+                            round(export_rss_mb / result_mb, 2) if result_mb else None
+                        ),
+                        "runs": [round(run["seconds"], 3) for run in runs],
+                        "import_seconds": round(
+                            min(run["import_seconds"] for run in runs), 3
+                        ),
+                        "cold_start_seconds": round(
+                            min(run["import_seconds"] + run["seconds"] for run in runs),
+                            3,
+                        ),
+                        "heavy_modules": best["heavy_modules"],
+                        "stages": best["stages"],
+                    }
+                )
+                print(
+                    f"  {mode:>6} -> {writer:<5} {seconds:8.2f} s "
+                    f"{best['rows'] / seconds:12,.0f} rows/s "
+                    f"{table_bytes / seconds / 1024 / 1024:8.1f} MB/s "
+                    f"peak {results['cases'][-1]['peak_rss_mb']:8.1f} MB "
+                    f"(+{export_rss_mb:6.1f} MB, "
+                    f"{results['cases'][-1]['peak_to_result'] or 0:5.2f}x result) "
+                    f"output {best['output_bytes'] / 1024 / 1024:8.1f} MB "
+                    f"import {results['cases'][-1]['import_seconds']:5.2f} s"
+                )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--run-case":
+        with open(os.environ["BENCHMARK_RESULT_FILE"], "w") as result_file:
+            json.dump(run_case(json.loads(sys.argv[2])), result_file)
+    else:
+        main()
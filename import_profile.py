@@ -0,0 +1,107 @@
+"""
+Report where the import time of the Lambda entry module goes.
+
+The module is imported in a fresh interpreter with `-X importtime`, which is
+what a cold start pays before the handler runs. The report lists the total,
+the slowest packages by cumulative time, and which of the heavy optional
+dependencies were loaded:
+
+    python import_profile.py
+    python import_profile.py --top 30 --statement "lambda_function.pd.DataFrame"
+
+`--statement` runs extra code after the import, for example to see what a
+lazily imported dependency costs when a code path first touches it.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Dependencies that the entry module only imports on the paths that need them.
+HEAVY_MODULES = ("pandas", "awswrangler", "sqlalchemy", "boto3", "pyarrow.dataset")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="lambda_function", help="Module to import.")
+    parser.add_argument(
+        "--statement", default="", help="Python code to run after the import."
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of packages to list."
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+def profile_import(module, statement=""):
+    """
+    Import a module in a fresh interpreter and parse its `-X importtime` log.
+
+    Returns:
+        tuple: Entries as `(package, depth, self_us, cumulative_us)` in load
+        order, and the names of the heavy modules that ended up loaded.
+    """
+    code = (
+        f"import sys, json, {module}\n"
+        f"{statement}\n"
+        f"print(json.dumps([name for name in {list(HEAVY_MODULES)!r} "
+        f"if name in sys.modules]))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if completed.returncode != 0:
+        sys.exit(completed.stderr.strip().splitlines()[-1])
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, package = line[len("import time:") :].split("|")
+        depth = (len(package) - len(package.lstrip())) // 2
+        entries.append((package.strip(), depth, int(self_us), int(cumulative_us)))
+    loaded = json.loads(completed.stdout.strip().splitlines()[-1])
+    return entries, loaded
+
+
+def main():
+    args = parse_args()
+    entries, loaded = profile_import(args.module, args.statement)
+    top_level = min(depth for _, depth, _, _ in entries)
+    total_us = sum(cum for _, depth, _, cum in entries if depth == top_level)
+    slowest = sorted(entries, key=lambda entry: entry[3], reverse=True)[: args.top]
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "module": args.module,
+                    "total_seconds": round(total_us / 1e6, 3),
+                    "heavy_modules_loaded": loaded,
+                    "slowest": [
+                        {
+                            "package": package,
+                            "self_seconds": round(self_us / 1e6, 3),
+                            "cumulative_seconds": round(cum / 1e6, 3),
+                        }
+                        for package, _, self_us, cum in slowest
+                    ],
+                },
+                indent=2,
+            )
+        )
+        return
+    extra = " and running the statement" if args.statement else ""
+    print(f"Importing {args.module}{extra} took {total_us / 1e6:.3f} s")
+    print(f"Heavy modules loaded: {', '.join(loaded) or 'none'}")
+    print(f"\n{'cumulative':>12} {'self':>10}  package")
+    for package, _, self_us, cum in slowest:
+        print(f"{cum / 1e6:10.3f} s {self_us / 1e6:8.3f} s  {package}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,59 @@
+import asyncio
+import atexit
+import collections
+import hashlib
+import importlib
+import itertools
 import json
 import logging
 import os
+import queue
+import resource
+import shlex
+import shutil
+import signal
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+import numpy as np
 import psycopg2
-import awswrangler as wr
-import pandas as pd
-from sqlalchemy import create_engine
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+
+    The heavy dependencies are only needed on some export paths (pandas and
+    SQLAlchemy for the `pandas` mode, awswrangler and boto3 for S3, the
+    dataset API for partitioned output), so deferring them keeps them out of
+    the cold start of the paths that do not use them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self._name), attribute)
+
+
+boto3 = _LazyModule("boto3")
+wr = _LazyModule("awswrangler")
+pd = _LazyModule("pandas")
+ds = _LazyModule("pyarrow.dataset")
+sqlalchemy = _LazyModule("sqlalchemy")
+# Optional, only needed by the "async" extraction mode.
+asyncpg = _LazyModule("asyncpg")
 
 # Configure logger(format: timestamp - log level - message)
 logging.basicConfig(
@@ -12,7 +61,347 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+# Extraction modes: "stream" reads the result through a server-side cursor,
+# "copy" decodes a binary COPY stream and "async" fetches, converts and writes
+# batches in overlapping stages with asyncpg. These build Arrow record batches
+# directly and write one row group per batch. "pandas" loads the full result
+# into a DataFrame, for compatibility with the pandas types of older exports.
+EXTRACT_MODES = ("pandas", "stream", "copy", "async")
+DEFAULT_BATCH_SIZE = 10000
+
+# Batches buffered between the stages of the async pipeline.
+ASYNC_QUEUE_SIZE = 2
+
+# Adaptive batch sizing keeps one batch under a share of the Lambda memory.
+# The Python rows of a fetch, or the raw COPY fields, plus the Arrow batch and
+# the encoded Parquet pages take several times the Arrow size of the batch.
+DEFAULT_BATCH_MEMORY_FRACTION = 0.25
+BATCH_MEMORY_OVERHEAD = 8
+ADAPTIVE_MIN_BATCH_SIZE = 1000
+ADAPTIVE_MAX_BATCH_SIZE = 1000000
+
+# Seconds kept free before the Lambda timeout to stop an export cleanly.
+DEFAULT_TIMEOUT_RESERVE_SECONDS = 10
+
+# PostgreSQL type OIDs understood by the binary COPY decoder. Columns of any
+# other type are cast to text on the server.
+PG_BOOL = 16
+PG_NAME = 19
+PG_INT8 = 20
+PG_INT2 = 21
+PG_INT4 = 23
+PG_TEXT = 25
+PG_JSON = 114
+PG_FLOAT4 = 700
+PG_FLOAT8 = 701
+PG_BPCHAR = 1042
+PG_VARCHAR = 1043
+PG_DATE = 1082
+PG_TIMESTAMP = 1114
+PG_TIMESTAMPTZ = 1184
+PG_NUMERIC = 1700
+PG_UUID = 2950
+PG_JSONB = 3802
+
+# The stream engine reads json and jsonb as their raw text instead of parsing
+# them into Python objects.
+JSON_AS_TEXT = psycopg2.extensions.new_type(
+    (PG_JSON,), "JSON_AS_TEXT", lambda value, curs: value
+)
+JSONB_AS_TEXT = psycopg2.extensions.new_type(
+    (PG_JSONB,), "JSONB_AS_TEXT", lambda value, curs: value
+)
+
+# Days and microseconds between the Unix epoch and the PostgreSQL epoch (2000-01-01).
+PG_EPOCH_DAYS = 10957
+PG_EPOCH_MICROS = PG_EPOCH_DAYS * 86400 * 1000000
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+# Partitioned extraction runs one slice per thread, each on its own connection.
+# Lambda allocates vCPUs in proportion to the memory setting.
+DEFAULT_PARTITION_COUNT = os.cpu_count() or 1
+
+# Connections and engines are kept open between warm invocations for at most
+# this many seconds.
+DEFAULT_CONNECTION_MAX_AGE = 300
+
+# Partitioned dataset output: write modes, target size of each file, and the
+# number of files uploaded to S3 at the same time.
+OUTPUT_MODES = ("overwrite", "append", "overwrite_partitions")
+DEFAULT_TARGET_FILE_SIZE_MB = 128
+DATASET_MAX_ROWS_PER_GROUP = 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 8
+
+# Batches held back before a Parquet file opens while a column whose type is
+# inferred from the data has only been NULL.
+NULL_TYPE_BUFFER_MB = 32
+
+# Sharded output: number of parts written at the same time, and batches queued
+# for each of them.
+DEFAULT_SHARD_WRITERS = 4
+SHARD_QUEUE_SIZE = 2
+
+# Multipart uploads to S3: size of each part (S3 requires at least 5 MiB for
+# all but the last part), number of parts buffered or uploading at a time, and
+# attempts per part.
+S3_MIN_PART_SIZE_MB = 5
+DEFAULT_S3_PART_SIZE_MB = 8
+DEFAULT_S3_MAX_IN_FLIGHT = 4
+S3_PART_ATTEMPTS = 3
+S3_PART_RETRY_DELAY = 0.5
+
+# Bytes read from the end of a Parquet object on S3 to get its footer in one
+# request. Larger footers take a second request.
+PARQUET_FOOTER_READ_BYTES = 64 * 1024
+
+# Footer metadata key of the distinct counts the batch writer measures for each
+# row group when output validation is on. Parquet statistics rarely hold them.
+PARQUET_DISTINCT_COUNTS_KEY = "distinct_counts"
+
+# Parquet compression codecs, and those that accept a compression level.
+PARQUET_CODECS = ("snappy", "zstd", "lz4", "gzip", "brotli", "none")
+PARQUET_LEVEL_CODECS = ("zstd", "gzip", "brotli")
+
+# Change data capture: logical decoding plugin of the replication slots, and
+# the most changes read from a slot per invocation.
+CDC_PLUGIN = "pgoutput"
+DEFAULT_CDC_MAX_CHANGES = 100000
+
+# Query diagnostics: EXPLAIN modes, and the table size from which a
+# sequential scan in the plan is reported with a warning.
+EXPLAIN_MODES = ("plan", "analyze")
+DEFAULT_SEQ_SCAN_WARN_ROWS = 1000000
+
+# Default of each export option. Every option can be set with the environment
+# variable of the same name in upper case, or per job in the invocation event.
+EXPORT_OPTION_DEFAULTS = {
+    "extract_mode": "stream",
+    "batch_size": DEFAULT_BATCH_SIZE,
+    "adaptive_batch_size": "false",
+    "batch_memory_fraction": DEFAULT_BATCH_MEMORY_FRACTION,
+    "timeout_reserve_seconds": DEFAULT_TIMEOUT_RESERVE_SECONDS,
+    "partition_column": None,
+    "partition_count": DEFAULT_PARTITION_COUNT,
+    "partition_table": None,
+    "watermark_column": None,
+    "checkpoint_column": None,
+    "job_id": None,
+    "result_cache": "false",
+    "cache_marker_column": None,
+    "cdc_slot": None,
+    "cdc_publication": None,
+    "cdc_max_changes": DEFAULT_CDC_MAX_CHANGES,
+    "explain_mode": None,
+    "seq_scan_warn_rows": DEFAULT_SEQ_SCAN_WARN_ROWS,
+    "validate_output": "false",
+    "dictionary_columns": None,
+    "output_partition_cols": None,
+    "output_mode": "overwrite",
+    "target_file_size_mb": DEFAULT_TARGET_FILE_SIZE_MB,
+    "max_file_size_mb": None,
+    "max_file_rows": None,
+    "shard_writers": DEFAULT_SHARD_WRITERS,
+    "s3_part_size_mb": DEFAULT_S3_PART_SIZE_MB,
+    "s3_max_in_flight": DEFAULT_S3_MAX_IN_FLIGHT,
+    "parquet_compression": None,
+    "parquet_compression_level": None,
+    "parquet_row_group_rows": None,
+    "parquet_row_group_mb": None,
+    "parquet_dictionary": None,
+    "parquet_statistics": None,
+    "parquet_sort_by": None,
+}
+
+# Number of jobs from one invocation event that run at the same time.
+DEFAULT_JOB_CONCURRENCY = 4
+
+# Number of query descriptions kept by `query_columns` in a warm container.
+QUERY_COLUMNS_CACHE_SIZE = 64
+
+# Event or job keys that narrow the exported query, and the filter operators
+# they accept with the SQL each one becomes.
+SELECTION_KEYS = ("columns", "filters", "limit")
+SELECTION_OPERATORS = {
+    "=": "=",
+    "!=": "<>",
+    "<>": "<>",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "like": "LIKE",
+    "ilike": "ILIKE",
+    "in": "IN",
+    "not in": "NOT IN",
+    "is null": "IS NULL",
+    "is not null": "IS NOT NULL",
+}
+
+# Extra arguments for every S3 write. Change to the desired storage class.
+S3_ADDITIONAL_KWARGS = {"StorageClass": "INTELLIGENT_TIERING"}
+
+# CloudWatch namespace of the stage metrics, and their Embedded Metric Format
+# names and units.
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Postgres2Parquet")
+METRIC_UNITS = {
+    "seconds": ("Seconds", "Seconds"),
+    "rows": ("Rows", "Count"),
+    "bytes_read": ("BytesRead", "Bytes"),
+    "bytes_written": ("BytesWritten", "Bytes"),
+    "peak_rss_mb": ("PeakRSS", "Megabytes"),
+}
+
+
+class StageMetrics:
+    """
+    Wall time, rows, bytes and peak memory of each stage of an invocation.
+
+    Stages running in several threads, such as partitions or jobs, add up
+    under the same stage name.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, stage, calls=0, seconds=0.0, rows=0, bytes_read=0, bytes_written=0
+    ):
+        """Add measurements to a stage and sample the peak RSS of the process."""
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        with self._lock:
+            values = self.stages.setdefault(
+                stage,
+                {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "rows": 0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "peak_rss_mb": 0.0,
+                },
+            )
+            values["calls"] += calls
+            values["seconds"] += seconds
+            values["rows"] += rows
+            values["bytes_read"] += bytes_read
+            values["bytes_written"] += bytes_written
+            values["peak_rss_mb"] = max(values["peak_rss_mb"], peak_rss_mb)
+
+    def reset(self):
+        """Clear the measurements of the previous invocation."""
+        with self._lock:
+            self.stages = {}
+
+    def summary(self):
+        """
+        Returns:
+            dict: Measurements of each stage, keyed by stage name.
+        """
+        with self._lock:
+            return {
+                stage: {
+                    **values,
+                    "seconds": round(values["seconds"], 3),
+                    "peak_rss_mb": round(values["peak_rss_mb"], 1),
+                }
+                for stage, values in self.stages.items()
+            }
+
+    def emit(self):
+        """
+        Print one structured log line per stage.
+
+        In AWS Lambda the lines use the CloudWatch Embedded Metric Format, so
+        CloudWatch extracts them as metrics with a `Stage` dimension. Locally
+        they are plain JSON lines.
+        """
+        function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+        for stage, values in self.summary().items():
+            if function_name is None:
+                print(json.dumps({"stage": stage, **values}), flush=True)
+                continue
+            record = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["FunctionName", "Stage"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit}
+                                for name, unit in METRIC_UNITS.values()
+                            ],
+                        }
+                    ],
+                },
+                "FunctionName": function_name,
+                "Stage": stage,
+            }
+            for key, (name, _) in METRIC_UNITS.items():
+                record[name] = values[key]
+            print(json.dumps(record), flush=True)
+
+
+# Metrics of the current invocation, reset by `lambda_handler`.
+_METRICS = StageMetrics()
+_STAGE_TIMING = threading.local()
+
+
+@contextmanager
+def measure_stage(stage):
+    """
+    Measure the wall time of a block as one call of a stage.
+
+    Time spent in stages nested in the block on the same thread is only
+    counted for the nested stage, so a writer pulling batches from the
+    extraction does not count the extraction time again.
+    """
+    outer = getattr(_STAGE_TIMING, "nested", 0.0)
+    _STAGE_TIMING.nested = 0.0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _METRICS.record(stage, calls=1, seconds=elapsed - _STAGE_TIMING.nested)
+        _STAGE_TIMING.nested = outer + elapsed
+
+
+def metered(stage):
+    """Decorate a function so that each call is measured as a stage."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure_stage(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_stage_metrics(stage, **values):
+    """Add rows or bytes to a stage of the current invocation."""
+    _METRICS.record(stage, **values)
+
+
+def _metered_batches(batches):
+    """Yield batches while measuring their extraction as the `query_database` stage."""
+    batches = iter(batches)
+    while True:
+        with measure_stage("query_database"):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        record_stage_metrics(
+            "query_database", rows=batch.num_rows, bytes_read=batch.nbytes
+        )
+        yield batch
+
 
+@metered("get_environment")
 def get_environment():
     """
     Get the staging flag based on the 'ENVIRONMENT' environment variable.
@@ -76,6 +465,281 @@ def load_environment_variables(staging):
         return handle_error(f"Missing required environment variable: {e}")
 
 
+def load_export_options(overrides=None):
+    """
+    Load the optional export settings from the environment.
+
+    Each option is read from the environment variable of the same name in
+    upper case, then replaced by the matching entry of `overrides`, if any.
+    Unset options fall back to `EXPORT_OPTION_DEFAULTS`, which stream the
+    query into one Parquet file through Arrow record batches.
+
+    Args:
+        overrides (dict): Optional per-job values, keyed by option name.
+
+    Returns:
+        dict: Validated export options, keyed by option name.
+    """
+    try:
+        logger.info("Loading export options...")
+        settings = {
+            name: os.environ.get(name.upper(), default)
+            for name, default in EXPORT_OPTION_DEFAULTS.items()
+        }
+        unknown = set(overrides or {}) - set(settings)
+        if unknown:
+            raise ValueError(f"Unknown option: {', '.join(sorted(unknown))}")
+        settings.update(overrides or {})
+
+        extract_mode = settings["extract_mode"]
+        if extract_mode not in EXTRACT_MODES:
+            raise ValueError(f"Invalid extract mode: {extract_mode}")
+        batch_size = int(settings["batch_size"])
+        if batch_size <= 0:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        adaptive_batch_size = str(settings["adaptive_batch_size"]).strip().lower()
+        if adaptive_batch_size not in ("true", "false"):
+            raise ValueError(f"Invalid adaptive batch switch: {adaptive_batch_size}")
+        batch_memory_fraction = float(settings["batch_memory_fraction"])
+        if not 0 < batch_memory_fraction <= 1:
+            raise ValueError(f"Invalid batch memory fraction: {batch_memory_fraction}")
+        timeout_reserve_seconds = float(settings["timeout_reserve_seconds"])
+        if timeout_reserve_seconds < 0:
+            raise ValueError(f"Invalid timeout reserve: {timeout_reserve_seconds}")
+        partition_column = settings["partition_column"] or None
+        partition_count = int(settings["partition_count"])
+        if partition_count <= 0:
+            raise ValueError(f"Invalid partition count: {partition_count}")
+        partition_table = settings["partition_table"] or None
+        if partition_column == "ctid" and not partition_table:
+            raise ValueError("PARTITION_TABLE is required to partition by ctid")
+        watermark_column = settings["watermark_column"] or None
+        result_cache = str(settings["result_cache"]).strip().lower()
+        if result_cache not in ("true", "false"):
+            raise ValueError(f"Invalid result cache switch: {result_cache}")
+        result_cache = result_cache == "true"
+        if result_cache and watermark_column:
+            raise ValueError("RESULT_CACHE cannot be combined with WATERMARK_COLUMN")
+        cache_marker_column = settings["cache_marker_column"] or None
+        dictionary_columns = _parse_list(settings["dictionary_columns"])
+        output_partition_cols = _parse_list(settings["output_partition_cols"])
+        if output_partition_cols and partition_column:
+            raise ValueError(
+                "OUTPUT_PARTITION_COLS cannot be combined with PARTITION_COLUMN"
+            )
+        output_mode = settings["output_mode"]
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Invalid output mode: {output_mode}")
+        if watermark_column and output_partition_cols and output_mode != "append":
+            # Each run only holds the new rows, so replacing files would lose
+            # the rows of earlier runs while the watermark moves past them.
+            raise ValueError(
+                "WATERMARK_COLUMN requires OUTPUT_MODE=append for a dataset"
+            )
+        target_file_size_mb = float(settings["target_file_size_mb"])
+        if target_file_size_mb <= 0:
+            raise ValueError(f"Invalid target file size: {target_file_size_mb}")
+        max_file_size_mb = settings["max_file_size_mb"]
+        max_file_size_mb = (
+            None if max_file_size_mb in (None, "") else float(max_file_size_mb)
+        )
+        max_file_rows = settings["max_file_rows"]
+        max_file_rows = None if max_file_rows in (None, "") else int(max_file_rows)
+        for size in (max_file_size_mb, max_file_rows):
+            if size is not None and size <= 0:
+                raise ValueError(f"Invalid maximum file size: {size}")
+        shard_writers = int(settings["shard_writers"])
+        if shard_writers <= 0:
+            raise ValueError(f"Invalid shard writer count: {shard_writers}")
+        if max_file_size_mb or max_file_rows:
+            for name, value in (
+                ("PARTITION_COLUMN", partition_column),
+                ("OUTPUT_PARTITION_COLS", output_partition_cols),
+            ):
+                if value:
+                    raise ValueError(
+                        f"Output file size limits cannot be combined with {name}"
+                    )
+        s3_part_size_mb = float(settings["s3_part_size_mb"])
+        if s3_part_size_mb < S3_MIN_PART_SIZE_MB:
+            raise ValueError(
+                f"S3 part size must be at least {S3_MIN_PART_SIZE_MB} MB: "
+                f"{s3_part_size_mb}"
+            )
+        s3_max_in_flight = int(settings["s3_max_in_flight"])
+        if s3_max_in_flight <= 0:
+            raise ValueError(f"Invalid S3 in-flight part count: {s3_max_in_flight}")
+        checkpoint_column = settings["checkpoint_column"] or None
+        job_id = settings["job_id"] or None
+        if job_id and ("/" in job_id or job_id.startswith(".")):
+            raise ValueError(f"Invalid job id: {job_id}")
+        if checkpoint_column:
+            if extract_mode == "pandas":
+                raise ValueError("CHECKPOINT_COLUMN requires the stream or copy mode")
+            for name, value in (
+                ("PARTITION_COLUMN", partition_column),
+                ("OUTPUT_PARTITION_COLS", output_partition_cols),
+                ("WATERMARK_COLUMN", watermark_column),
+                ("RESULT_CACHE", result_cache),
+                ("MAX_FILE_SIZE_MB", max_file_size_mb),
+                ("MAX_FILE_ROWS", max_file_rows),
+            ):
+                if value:
+                    raise ValueError(
+                        f"CHECKPOINT_COLUMN cannot be combined with {name}"
+                    )
+        cdc_slot = settings["cdc_slot"] or None
+        cdc_publication = settings["cdc_publication"] or None
+        cdc_max_changes = int(settings["cdc_max_changes"])
+        if cdc_max_changes <= 0:
+            raise ValueError(f"Invalid change count: {cdc_max_changes}")
+        if cdc_slot:
+            if set(cdc_slot) - set("abcdefghijklmnopqrstuvwxyz0123456789_"):
+                raise ValueError(f"Invalid replication slot name: {cdc_slot}")
+            if not cdc_publication:
+                raise ValueError("CDC_PUBLICATION is required with CDC_SLOT")
+            for name, value in (
+                ("PARTITION_COLUMN", partition_column),
+                ("OUTPUT_PARTITION_COLS", output_partition_cols),
+                ("WATERMARK_COLUMN", watermark_column),
+                ("CHECKPOINT_COLUMN", checkpoint_column),
+                ("RESULT_CACHE", result_cache),
+                ("MAX_FILE_SIZE_MB", max_file_size_mb),
+                ("MAX_FILE_ROWS", max_file_rows),
+            ):
+                if value:
+                    raise ValueError(f"CDC_SLOT cannot be combined with {name}")
+        explain_mode = settings["explain_mode"] or None
+        if explain_mode is not None:
+            explain_mode = explain_mode.lower()
+            if explain_mode not in EXPLAIN_MODES:
+                raise ValueError(f"Invalid explain mode: {explain_mode}")
+            if cdc_slot:
+                raise ValueError("EXPLAIN_MODE cannot be combined with CDC_SLOT")
+        seq_scan_warn_rows = int(settings["seq_scan_warn_rows"])
+        if seq_scan_warn_rows < 0:
+            raise ValueError(f"Invalid sequential scan threshold: {seq_scan_warn_rows}")
+        validate_output = str(settings["validate_output"]).strip().lower()
+        if validate_output not in ("true", "false"):
+            raise ValueError(f"Invalid output validation switch: {validate_output}")
+        validate_output = validate_output == "true"
+        if validate_output:
+            if cdc_slot:
+                raise ValueError("VALIDATE_OUTPUT cannot be combined with CDC_SLOT")
+            if output_partition_cols and output_mode != "overwrite":
+                # Files kept from earlier runs would be counted too.
+                raise ValueError(
+                    "VALIDATE_OUTPUT requires OUTPUT_MODE=overwrite for a dataset"
+                )
+        logger.info(f"Export options loaded (extract mode: {extract_mode})")
+        return {
+            "extract_mode": extract_mode,
+            "batch_size": batch_size,
+            "adaptive_batch_size": adaptive_batch_size == "true",
+            "batch_memory_fraction": batch_memory_fraction,
+            "timeout_reserve_seconds": timeout_reserve_seconds,
+            "partition_column": partition_column,
+            "partition_count": partition_count,
+            "partition_table": partition_table,
+            "watermark_column": watermark_column,
+            "checkpoint_column": checkpoint_column,
+            "job_id": job_id,
+            "result_cache": result_cache,
+            "cache_marker_column": cache_marker_column,
+            "cdc_slot": cdc_slot,
+            "cdc_publication": cdc_publication,
+            "cdc_max_changes": cdc_max_changes,
+            "explain_mode": explain_mode,
+            "seq_scan_warn_rows": seq_scan_warn_rows,
+            "validate_output": validate_output,
+            "dictionary_columns": dictionary_columns,
+            "output_partition_cols": output_partition_cols,
+            "output_mode": output_mode,
+            "target_file_size_mb": target_file_size_mb,
+            "max_file_size_mb": max_file_size_mb,
+            "max_file_rows": max_file_rows,
+            "shard_writers": shard_writers,
+            "s3_part_size_mb": s3_part_size_mb,
+            "s3_max_in_flight": s3_max_in_flight,
+            **_load_parquet_options(settings),
+        }
+    except ValueError as e:
+        return handle_error(f"Invalid export option: {e}")
+
+
+def _load_parquet_options(settings):
+    """
+    Validate the Parquet writer settings.
+
+    Unset settings stay None, so that the library defaults apply.
+
+    Args:
+        settings (dict): Raw export settings, keyed by option name.
+
+    Returns:
+        dict: Validated Parquet options, keyed by option name.
+    """
+    compression = settings["parquet_compression"] or None
+    if compression is not None:
+        compression = compression.lower()
+        if compression not in PARQUET_CODECS:
+            raise ValueError(f"Invalid Parquet compression: {compression}")
+    level = settings["parquet_compression_level"]
+    level = None if level in (None, "") else int(level)
+    if level is not None and compression not in PARQUET_LEVEL_CODECS:
+        raise ValueError(
+            f"Compression level requires one of: {', '.join(PARQUET_LEVEL_CODECS)}"
+        )
+    row_group_rows = settings["parquet_row_group_rows"]
+    row_group_rows = None if row_group_rows in (None, "") else int(row_group_rows)
+    row_group_mb = settings["parquet_row_group_mb"]
+    row_group_mb = None if row_group_mb in (None, "") else float(row_group_mb)
+    if row_group_rows is not None and row_group_mb is not None:
+        raise ValueError(
+            "Set only one of PARQUET_ROW_GROUP_ROWS and PARQUET_ROW_GROUP_MB"
+        )
+    for size in (row_group_rows, row_group_mb):
+        if size is not None and size <= 0:
+            raise ValueError(f"Invalid row group size: {size}")
+    sort_by = []
+    for key in _parse_list(settings["parquet_sort_by"]):
+        column, _, order = key.partition(":")
+        order = order.strip().lower() or "asc"
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Invalid sort order: {key}")
+        sort_by.append(
+            (column.strip(), "ascending" if order == "asc" else "descending")
+        )
+    return {
+        "parquet_compression": compression,
+        "parquet_compression_level": level,
+        "parquet_row_group_rows": row_group_rows,
+        "parquet_row_group_mb": row_group_mb,
+        "parquet_dictionary": _parse_flag_or_list(settings["parquet_dictionary"]),
+        "parquet_statistics": _parse_flag_or_list(settings["parquet_statistics"]),
+        "parquet_sort_by": sort_by or None,
+    }
+
+
+def _parse_flag_or_list(value):
+    """Parse a `true`/`false` switch, or a list of the columns it applies to."""
+    if value is None or value == "" or isinstance(value, bool):
+        return value if value != "" else None
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    return _parse_list(value)
+
+
+def _parse_list(value):
+    """Parse a comma-separated string, or a list from a job, into a list of names."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item.strip()]
+
+
+@metered("connect_to_db")
 def connect_to_db(db_name, db_user, db_password, db_host, db_port):
     """
     Connect to the PostgreSQL database.
@@ -105,6 +769,230 @@ def connect_to_db(db_name, db_user, db_password, db_host, db_port):
         return handle_error(f"Database connection error: {e}")
 
 
+def acquire_connection(db_params, snapshot=None):
+    """
+    Get a database connection, reusing one kept open by a previous warm invocation.
+
+    Idle connections are health checked with a ping before reuse, and closed
+    once they are older than `DB_CONNECTION_MAX_AGE` seconds. A new connection
+    is opened when no healthy one is available.
+
+    Args:
+        db_params (tuple): Arguments for `connect_to_db`.
+        snapshot (str): Optional snapshot from `export_snapshot`. The
+            connection then starts a `REPEATABLE READ` transaction on it, so
+            its queries see the same data as every other connection that
+            imported it. The client encoding is set to UTF8 first, since
+            changing it later would end that transaction.
+
+    Returns:
+        psycopg2.extensions.connection: A PostgreSQL database connection.
+    """
+    conn = _pooled_connection(db_params)
+    if snapshot is None or is_error_response(conn):
+        return conn
+    try:
+        conn.set_client_encoding("UTF8")
+        with conn.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            curs.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        return conn
+    except psycopg2.Error as e:
+        release_connection(conn, db_params)
+        return handle_error(f"Snapshot error: {e}")
+
+
+def export_snapshot(db_params):
+    """
+    Open a coordinator transaction and export its snapshot to other connections.
+
+    The snapshot stays importable with `acquire_connection` as long as the
+    coordinator transaction is open, so the coordinator must only be released
+    once every export using it has started its queries.
+
+    Args:
+        db_params (tuple): Arguments for `connect_to_db`.
+
+    Returns:
+        tuple: The coordinator connection and the snapshot identifier.
+    """
+    conn = _pooled_connection(db_params)
+    if is_error_response(conn):
+        return conn
+    try:
+        with conn.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            curs.execute("SELECT pg_export_snapshot()")
+            snapshot = curs.fetchone()[0]
+        logger.info(f"Exported snapshot {snapshot}")
+        return conn, snapshot
+    except psycopg2.Error as e:
+        release_connection(conn, db_params)
+        return handle_error(f"Snapshot error: {e}")
+
+
+def _pooled_connection(db_params):
+    """Take a healthy warm connection from the pool, or open a new one."""
+    while True:
+        with _CONNECTION_POOL_LOCK:
+            idle = _CONNECTION_POOL.get(db_params)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            break
+        created_at, connect_seconds = _CONNECTION_INFO[conn]
+        if time.monotonic() - created_at > _connection_max_age():
+            logger.info("Warm DB connection expired")
+            _discard_connection(conn)
+            continue
+        try:
+            with conn.cursor() as curs:
+                curs.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error as e:
+            logger.info(f"Warm DB connection failed health check: {e}")
+            _discard_connection(conn)
+            continue
+        logger.info(
+            "Reusing warm DB connection "
+            f"(saved {connect_seconds * 1000:.0f} ms of connection setup)"
+        )
+        return conn
+
+    start = time.perf_counter()
+    conn = connect_to_db(*db_params)
+    if not is_error_response(conn):
+        _CONNECTION_INFO[conn] = (time.monotonic(), time.perf_counter() - start)
+    return conn
+
+
+def release_connection(conn, db_params):
+    """
+    Return a connection to the warm pool, or close it.
+
+    Any open transaction is rolled back first. Connections are closed instead
+    of pooled when reuse is disabled with `DB_CONNECTION_REUSE=false`, when they
+    are broken, or when they have outlived `DB_CONNECTION_MAX_AGE`.
+
+    Args:
+        conn (psycopg2.extensions.connection): Connection from `acquire_connection`.
+        db_params (tuple): Arguments for `connect_to_db` used to open it.
+
+    Returns:
+        None
+    """
+    if conn is None or is_error_response(conn):
+        return
+    info = _CONNECTION_INFO.get(conn)
+    reuse = os.environ.get("DB_CONNECTION_REUSE", "true").lower() == "true"
+    try:
+        if (
+            reuse
+            and info is not None
+            and conn.closed == 0
+            and time.monotonic() - info[0] <= _connection_max_age()
+        ):
+            conn.rollback()
+            with _CONNECTION_POOL_LOCK:
+                _CONNECTION_POOL.setdefault(db_params, []).append(conn)
+            logger.info("DB connection kept open for the next invocation")
+            return
+    except psycopg2.Error:
+        pass
+    _discard_connection(conn)
+    logger.info("DB connection closed")
+
+
+def close_all_connections():
+    """
+    Close every pooled connection and cached engine.
+
+    Registered to run when the Lambda runtime shuts the container down.
+    """
+    with _CONNECTION_POOL_LOCK:
+        idle = [conn for pool in _CONNECTION_POOL.values() for conn in pool]
+        _CONNECTION_POOL.clear()
+    for conn in idle:
+        _discard_connection(conn)
+    for engine in _ENGINES.values():
+        engine.dispose()
+    _ENGINES.clear()
+
+
+def get_engine(url):
+    """
+    Get the SQLAlchemy engine for a database URL, created once per container.
+
+    The engine keeps its own connection pool, pinged before each checkout and
+    recycled after `DB_CONNECTION_MAX_AGE` seconds, so warm invocations skip
+    its connection setup as well.
+
+    Args:
+        url (str): SQLAlchemy database URL.
+
+    Returns:
+        sqlalchemy.engine.Engine: The cached engine.
+    """
+    with _CONNECTION_POOL_LOCK:
+        engine = _ENGINES.get(url)
+        if engine is None:
+            engine = sqlalchemy.create_engine(
+                url, pool_pre_ping=True, pool_recycle=_connection_max_age()
+            )
+            _ENGINES[url] = engine
+        else:
+            logger.info("Reusing warm SQLAlchemy engine")
+        return engine
+
+
+def _connection_max_age():
+    """
+    Maximum lifetime of a pooled connection, in seconds.
+
+    An invalid `DB_CONNECTION_MAX_AGE` falls back to the default with a
+    warning, since it is read wherever connections are taken or returned.
+    """
+    value = os.environ.get("DB_CONNECTION_MAX_AGE", DEFAULT_CONNECTION_MAX_AGE)
+    try:
+        max_age = int(value)
+    except ValueError:
+        max_age = -1
+    if max_age < 0:
+        logger.warning(
+            f"Invalid DB_CONNECTION_MAX_AGE: {value}, using "
+            f"{DEFAULT_CONNECTION_MAX_AGE} seconds"
+        )
+        return DEFAULT_CONNECTION_MAX_AGE
+    return max_age
+
+
+def _discard_connection(conn):
+    """Close a connection and forget its pool metadata."""
+    _CONNECTION_INFO.pop(conn, None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def _close_on_sigterm(signum, frame):
+    """Close pooled connections when the Lambda runtime stops the container."""
+    close_all_connections()
+    if callable(_PREVIOUS_SIGTERM_HANDLER):
+        _PREVIOUS_SIGTERM_HANDLER(signum, frame)
+    raise SystemExit(0)
+
+
+_CONNECTION_POOL = {}
+_CONNECTION_INFO = {}
+_ENGINES = {}
+_CONNECTION_POOL_LOCK = threading.RLock()
+atexit.register(close_all_connections)
+_PREVIOUS_SIGTERM_HANDLER = None
+if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+    _PREVIOUS_SIGTERM_HANDLER = signal.signal(signal.SIGTERM, _close_on_sigterm)
+
+
+@metered("read_sql_query_from_file")
 def read_sql_query_from_file(file_path):
     """
     Read and return the SQL query from a file.
@@ -126,6 +1014,7 @@ def read_sql_query_from_file(file_path):
         return handle_error(f"Error reading SQL query file: {e}")
 
 
+@metered("query_database")
 def query_database(conn, sql_query, db_name, db_user, db_password, db_host, db_port):
     """
     Execute a SQL query against the PostgreSQL database.
@@ -142,117 +1031,3963 @@ def query_database(conn, sql_query, db_name, db_user, db_password, db_host, db_p
     Returns:
         pandas.DataFrame: Query result as a DataFrame.
     """
-    engine = create_engine(
+    engine = get_engine(
         f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
     )
 
     try:
         logger.info("Querying DB...")
-        with conn.cursor() as curr:
-            logger.info("Executing query...")
-            query_result = pd.read_sql_query(sql_query, engine)
+        logger.info("Executing query...")
+        query_result = pd.read_sql_query(sql_query, engine)
+        record_stage_metrics(
+            "query_database",
+            rows=len(query_result),
+            bytes_read=int(query_result.memory_usage(index=False).sum()),
+        )
         return query_result
     except Exception as e:
         return handle_error(f"Database query error: {e}")
 
 
-def write_to_s3_or_local(data, staging, file_name, path):
+def stream_query_batches(conn, sql_query, batch_size, dictionary_columns=()):
     """
-    Write data to either Amazon S3 or local storage based on the testing flag.
+    Stream the result of a SQL query as Arrow record batches.
+
+    The query runs through a named (server-side) cursor so that at most
+    `batch_size` rows are held in memory at any time. Column types are taken
+    from the type OIDs and modifiers of the cursor description (see
+    `arrow_types_from_description`), so nullable integers stay integers and
+    numerics keep their precision. Columns of other types are inferred on the
+    first batch.
 
     Args:
-        data (pandas.DataFrame): Data to be written.
-        staging (bool): True if the application is in staging mode, False if in production mode.
-        file_name (str): Name of the output file.
-        path (str): Storage path.
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to execute.
+        batch_size (int or BatchSizer): Number of rows fetched per round-trip
+            and per batch, or a sizer read before each fetch.
+        dictionary_columns (Iterable[str]): Text columns to dictionary-encode.
+
+    Yields:
+        pyarrow.RecordBatch: The next batch of rows. An empty result yields a
+        single empty batch so that the output file still carries the columns.
+    """
+    logger.info("Streaming query results...")
+    with conn.cursor(name="postgres2parquet") as curs:
+        _register_json_as_text(curs)
+        curs.itersize = _batch_rows(batch_size)
+        curs.execute(sql_query)
+        schema = None
+        while True:
+            rows = curs.fetchmany(_batch_rows(batch_size))
+            if not rows and schema is not None:
+                break
+            if schema is None:
+                # Named cursors only describe the result after the first fetch.
+                columns = [column[0] for column in curs.description]
+                types = arrow_types_from_description(
+                    curs.description, dictionary_columns
+                )
+            with measure_stage("conversion"):
+                batch = _rows_to_record_batch(rows, columns, types)
+            schema = batch.schema
+            types = _pinned_types(types, batch)
+            yield batch
+            if not rows:
+                break
+
+
+def _register_json_as_text(curs):
+    """Read json and jsonb columns of a psycopg2 cursor as their raw text."""
+    if isinstance(curs, psycopg2.extensions.cursor):
+        for json_type in (JSON_AS_TEXT, JSONB_AS_TEXT):
+            psycopg2.extensions.register_type(json_type, curs)
+
+
+def arrow_types_from_description(description, dictionary_columns=()):
+    """
+    Map the columns of a cursor description to Arrow types.
+
+    The type OID and the precision and scale decoded from the type modifier
+    select the same types as the binary COPY decoder: sized integers,
+    `decimal128` for numerics with a declared precision, UTC timestamps for
+    `timestamptz`, and strings for text, `uuid`, `json` and `jsonb`. Text
+    columns listed in `dictionary_columns` become dictionary-encoded.
+
+    Args:
+        description (Sequence): `cursor.description` of an executed query.
+        dictionary_columns (Iterable[str]): Text columns to dictionary-encode.
 
     Returns:
-        None
+        list: The Arrow type of each column, or None for types left to inference.
     """
-    try:
-        if not staging:
-            logger.info("Writing result to S3...")
-            # Write result to S3 when not in testing mode
-            wr.s3.to_parquet(
-                df=data,
-                path=os.path.join(path, file_name),
-                s3_additional_kwargs={
-                    "StorageClass": "INTELLIGENT_TIERING"
-                },  # Change to the desired storage class.
+    dictionary_columns = set(dictionary_columns or ())
+    types = []
+    for column in description:
+        name, oid, precision, scale = column[0], column[1], column[4], column[5]
+        if oid in PgBinaryDecoder.SUPPORTED_TYPES:
+            types.append(
+                _dictionary_type(
+                    name, _pg_arrow_type(oid, precision, scale), dictionary_columns
+                )
             )
         else:
-            logger.info("Writing result to local storage...")
-            # Save the DataFrame to Parquet for local storage
-            print(
-                os.path.join(path, file_name),
-            )
-            data.to_parquet(os.path.join(path, file_name), index=False)
+            types.append(None)
+    return types
 
-        logger.info(f"Result written to {path + file_name}")
-    except Exception as e:
-        return handle_error(f"Error writing data: {e}")
 
+def _dictionary_type(name, arrow_type, dictionary_columns):
+    """Return the dictionary-encoded type of a listed text column."""
+    if name in dictionary_columns and pa.types.is_string(arrow_type):
+        return pa.dictionary(pa.int32(), pa.string())
+    return arrow_type
 
-def handle_error(error):
+
+def extract_batches(conn, sql_query, options):
     """
-    Handle and log an error.
+    Run a SQL query with the batch extraction engine selected in the options.
 
-    Parameters:
-    - error (str or Exception): The error message or exception to be logged.
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to execute.
+        options (dict): Export options from `load_export_options`.
+
+    With `adaptive_batch_size`, batches are resized from the measured bytes
+    per row (see `BatchSizer`). When the invocation has a deadline, the
+    extraction stops with a `TimeoutError` before it would run into the
+    Lambda timeout (see `_stop_before_deadline`).
 
     Returns:
-    - dict: A dictionary containing an error response with a status code and error message.
+        Iterator[pyarrow.RecordBatch]: Query result as record batches.
+    """
+    batch_size = options["batch_size"]
+    if options["adaptive_batch_size"]:
+        # Partition slices are extracted at the same time and share the memory.
+        slices = options["partition_count"] if options["partition_column"] else 1
+        batch_size = BatchSizer(
+            batch_size,
+            _memory_limit_mb(),
+            options["batch_memory_fraction"] / slices,
+        )
+    if options["extract_mode"] == "copy":
+        batches = copy_query_batches(
+            conn, sql_query, batch_size, options["dictionary_columns"]
+        )
+    elif options["extract_mode"] == "async":
+        batches = async_query_batches(
+            conn, sql_query, batch_size, options["dictionary_columns"]
+        )
+    else:
+        batches = stream_query_batches(
+            conn, sql_query, batch_size, options["dictionary_columns"]
+        )
+    batches = _metered_batches(batches)
+    if isinstance(batch_size, BatchSizer):
+        batches = batch_size.observe(batches)
+    return _stop_before_deadline(batches, options["timeout_reserve_seconds"])
 
-    This function logs the provided error message using the logger's error level
-    and returns an HTTP-like error response as a dictionary. It is typically used
-    in Lambda functions to handle and report errors.
 
-    Example:
-    If you call handle_error("An error occurred."), it logs the error and returns:
-    {"statusCode": 500, "body": "Error: An error occurred."}
+class BatchSizer:
+    """
+    Size fetched batches so that one batch stays under a share of the memory.
+
+    The Arrow size of the batches gives the bytes per row of the actual data,
+    so wide rows get smaller batches and narrow rows fewer round-trips. The
+    size is read before each fetch, and updated as batches are consumed.
     """
-    logger.error(f"Error: {str(error)}")
-    return {"statusCode": 500, "body": f"Error: {str(error)}"}
 
+    def __init__(self, batch_size, memory_mb, memory_fraction):
+        """
+        Args:
+            batch_size (int): Rows of the first batch, before any row is measured.
+            memory_mb (float): Memory available to the function, in MB.
+            memory_fraction (float): Share of the memory for one batch.
+        """
+        self.size = batch_size
+        self.budget = memory_mb * 1024 * 1024 * memory_fraction / BATCH_MEMORY_OVERHEAD
+        self.bytes_per_row = None
 
-def lambda_handler(event, context):
+    def observe(self, batches):
+        """Yield the batches unchanged while resizing the next ones."""
+        for batch in batches:
+            if batch.num_rows:
+                measured = batch.nbytes / batch.num_rows
+                if self.bytes_per_row is not None:
+                    measured = (self.bytes_per_row + measured) / 2
+                self.bytes_per_row = measured
+                size = int(self.budget / max(measured, 1))
+                size = min(max(size, ADAPTIVE_MIN_BATCH_SIZE), ADAPTIVE_MAX_BATCH_SIZE)
+                if size != self.size:
+                    logger.info(
+                        f"Batch size set to {size} rows ({measured:.0f} bytes per row)"
+                    )
+                    self.size = size
+            yield batch
+
+
+def _batch_rows(batch_size):
+    """Get the current number of rows per batch of a fixed size or a `BatchSizer`."""
+    return batch_size.size if isinstance(batch_size, BatchSizer) else batch_size
+
+
+def _memory_limit_mb():
+    """Memory of the Lambda function, or of the machine when run locally, in MB."""
+    memory = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory:
+        return float(memory)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 / 1024
+
+
+def set_deadline(context):
     """
-    AWS Lambda entry point.
+    Record when the current invocation times out, from its Lambda context.
 
     Args:
-        event: AWS Lambda event.
-        context: AWS Lambda context.
+        context: AWS Lambda context, or None when run without one.
+    """
+    global _DEADLINE
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    _DEADLINE = None if remaining is None else time.monotonic() + remaining() / 1000
 
-    Returns:
-        dict: AWS Lambda response.
+
+def _stop_before_deadline(batches, reserve_seconds):
     """
-    logger.info("Starting Postgres2Parquet Lambda Function...")
+    Yield batches until the next one might not be written before the timeout.
 
+    Before each fetch, the time left must cover the reserve plus the slowest
+    fetch-and-write cycle so far. Otherwise a `TimeoutError` is raised, so the
+    writer aborts its upload or removes its partial file, the connection goes
+    back to the pool and the metrics are emitted, instead of the function
+    being killed mid-write.
+    """
+    batches = iter(batches)
+    deadline = _DEADLINE
+    if deadline is None:
+        yield from batches
+        return
+    rows = 0
+    slowest = 0.0
     try:
-        staging = get_environment()
-        (
-            db_name,
-            db_user,
-            db_password,
-            db_host,
-            db_port,
-            file_name,
-            path,
-        ) = load_environment_variables(staging)
-        conn = connect_to_db(db_name, db_user, db_password, db_host, db_port)
-        sql_query = read_sql_query_from_file("query.sql")
+        while True:
+            start = time.monotonic()
+            if deadline - start < reserve_seconds + slowest:
+                raise TimeoutError(
+                    f"Export stopped {deadline - start:.1f} s before the Lambda "
+                    f"timeout after {rows} rows"
+                )
+            batch = next(batches, None)
+            if batch is None:
+                return
+            rows += batch.num_rows
+            yield batch
+            slowest = max(slowest, time.monotonic() - start)
+    finally:
+        close = getattr(batches, "close", None)
+        if close is not None:
+            close()
 
-        try:
-            query_result = query_database(
-                conn, sql_query, db_name, db_user, db_password, db_host, db_port
+
+_DEADLINE = None
+
+
+def _pinned_types(types, batch):
+    """
+    Pin the column types inferred from a batch for the following batches.
+
+    Columns that are all NULL so far infer Arrow's `null` type, which no later
+    value could be cast to, so they stay unpinned until a batch has a value.
+    """
+    return [
+        inferred if known is None and not pa.types.is_null(inferred) else known
+        for known, inferred in zip(types, batch.schema.types)
+    ]
+
+
+def _rows_to_record_batch(rows, columns, types=None):
+    """
+    Build an Arrow record batch from a list of row tuples.
+
+    Each column is built directly with its type from `types`. Columns without
+    a known type are inferred, and the caller reuses the inferred types for the
+    following batches so that every row group of the output file shares the
+    same schema.
+    """
+    values = list(zip(*rows)) if rows else [[] for _ in columns]
+    types = types or [None] * len(columns)
+    arrays = [
+        _values_to_array(column_values, arrow_type)
+        for column_values, arrow_type in zip(values, types)
+    ]
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def _values_to_array(values, arrow_type):
+    """
+    Convert the Python values of one column into an Arrow array of the given type.
+
+    Values the driver returns as other objects are converted to match: numerics
+    kept as text and UUIDs are stringified, and numeric NaN becomes null like
+    in the COPY decoder.
+    """
+    if arrow_type is None or pa.types.is_null(arrow_type):
+        return pa.array(values)
+    if pa.types.is_dictionary(arrow_type):
+        return _values_to_array(values, arrow_type.value_type).dictionary_encode()
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if pa.types.is_string(arrow_type):
+            values = [value if value is None else str(value) for value in values]
+        elif pa.types.is_decimal(arrow_type):
+            values = [
+                value if value is None or value.is_finite() else None
+                for value in values
+            ]
+        else:
+            raise
+        return pa.array(values, type=arrow_type)
+
+
+def copy_query_batches(conn, sql_query, batch_size, dictionary_columns=()):
+    """
+    Stream the result of a SQL query through a binary COPY as Arrow record batches.
+
+    The query is first described with `LIMIT 0` to learn the column types, then
+    exported with `COPY (...) TO STDOUT (FORMAT binary)`. The binary stream is
+    decoded column by column into Arrow buffers, skipping the per-row Python
+    objects built by the cursor and pandas paths.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to execute.
+        batch_size (int or BatchSizer): Number of rows per batch, or a sizer
+            read as the stream is decoded.
+        dictionary_columns (Iterable[str]): Text columns to dictionary-encode.
+
+    Yields:
+        pyarrow.RecordBatch: The next batch of rows. An empty result yields a
+        single empty batch so that the output file still carries the columns.
+    """
+    sql_query = _strip_sql(sql_query)
+    logger.info("Describing query columns...")
+    with conn.cursor() as curs:
+        curs.execute(f"SELECT * FROM (\n{sql_query}\n) AS q LIMIT 0")
+        description = curs.description
+
+    fields = []
+    select_list = []
+    for column in description:
+        name, oid, precision, scale = column[0], column[1], column[4], column[5]
+        if oid in PgBinaryDecoder.SUPPORTED_TYPES:
+            fields.append((name, oid, precision, scale))
+            select_list.append(_quote_ident(name))
+        else:
+            fields.append((name, PG_TEXT, None, None))
+            select_list.append(f"{_quote_ident(name)}::text")
+    copy_sql = (
+        f"COPY (SELECT {', '.join(select_list)} FROM (\n{sql_query}\n) AS q) "
+        "TO STDOUT (FORMAT binary)"
+    )
+
+    decoder = PgBinaryDecoder(fields, batch_size, dictionary_columns)
+    batches = queue.Queue(maxsize=2)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            if (
+                conn.encoding != "UTF8"
+                and conn.get_transaction_status()
+                == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+            ):
+                # psycopg2 ends the open transaction to change the encoding,
+                # which would drop an imported snapshot without an error.
+                raise RuntimeError(
+                    f"COPY needs the UTF8 client encoding, not {conn.encoding}, "
+                    "and it cannot be changed inside the open transaction"
+                )
+            conn.set_client_encoding("UTF8")
+            sink = _CopyBatchSink(decoder, batches, stopped)
+            with conn.cursor() as curs:
+                curs.copy_expert(copy_sql, sink)
+            sink.close()
+            _put_until_stopped(batches, None, stopped)
+        except Exception as e:
+            _put_until_stopped(batches, e, stopped)
+
+    logger.info("Copying query results...")
+    producer = threading.Thread(target=produce, name="copy-producer", daemon=True)
+    producer.start()
+    try:
+        emitted = False
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item.num_rows or not emitted:
+                emitted = True
+                yield item
+        if not emitted:
+            yield decoder.schema.empty_table().to_batches()[0]
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def _asyncpg_connect_kwargs(conn):
+    """
+    Build the arguments of `asyncpg.connect` from the parameters of a psycopg2 connection.
+
+    Besides the address and credentials, libpq's `sslmode` becomes asyncpg's
+    `ssl`, with a context trusting `sslrootcert` for the verifying modes,
+    `connect_timeout` becomes `timeout`, and the `-c name=value` settings of
+    `options` become `server_settings`. The parameters are the effective ones,
+    so settings taken from `PGSSLMODE` and the like apply as well.
+    """
+    info = conn.info
+    dsn = conn.get_dsn_parameters()
+    kwargs = {
+        "host": info.host,
+        "port": info.port,
+        "user": info.user,
+        "password": info.password,
+        "database": info.dbname,
+    }
+    sslmode = dsn.get("sslmode")
+    if sslmode:
+        rootcert = dsn.get("sslrootcert")
+        if sslmode in ("verify-ca", "verify-full") and rootcert:
+            context = ssl.create_default_context(cafile=rootcert)
+            context.check_hostname = sslmode == "verify-full"
+            kwargs["ssl"] = context
+        else:
+            kwargs["ssl"] = sslmode
+    if dsn.get("connect_timeout"):
+        kwargs["timeout"] = float(dsn["connect_timeout"])
+    if dsn.get("options"):
+        kwargs["server_settings"] = _server_settings(dsn["options"])
+    return kwargs
+
+
+def _server_settings(options):
+    """Parse the `-c name=value` and `--name=value` settings of libpq `options`."""
+    settings = {}
+    tokens = iter(shlex.split(options))
+    for token in tokens:
+        if token == "-c":
+            token = next(tokens, "")
+        elif token.startswith("-c"):
+            token = token[2:]
+        elif token.startswith("--"):
+            token = token[2:]
+        else:
+            raise ValueError(f"Unsupported connection option: {token}")
+        name, separator, value = token.partition("=")
+        if not separator:
+            raise ValueError(f"Unsupported connection option: {token}")
+        settings[name.replace("-", "_")] = value
+    return settings
+
+
+def async_query_batches(conn, sql_query, batch_size, dictionary_columns=()):
+    """
+    Stream the result of a SQL query through an asyncio pipeline.
+
+    An event loop on a background thread fetches rows with an asyncpg
+    server-side cursor and converts each fetch into a record batch in an
+    executor, while the caller writes the previous batch and the multipart
+    writer uploads parts. Bounded queues between the stages apply
+    backpressure, so the export runs at the pace of its slowest stage and
+    memory stays bounded. Column types are read from a `LIMIT 0` query on the
+    psycopg2 connection, whose parameters, including its TLS settings, are
+    reused to open the asyncpg one (see `_asyncpg_connect_kwargs`).
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to execute.
+        batch_size (int or BatchSizer): Number of rows per fetch and per batch.
+        dictionary_columns (Iterable[str]): Text columns to dictionary-encode.
+
+    Yields:
+        pyarrow.RecordBatch: The next batch of rows. An empty result yields a
+        single empty batch so that the output file still carries the columns.
+    """
+    sql_query = _strip_sql(sql_query)
+    logger.info("Describing query columns...")
+    with conn.cursor() as curs:
+        curs.execute(f"SELECT * FROM (\n{sql_query}\n) AS q LIMIT 0")
+        description = curs.description
+    columns = [column[0] for column in description]
+    types = arrow_types_from_description(description, dictionary_columns)
+    connect_kwargs = _asyncpg_connect_kwargs(conn)
+    batches = queue.Queue(maxsize=ASYNC_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    async def fetch(fetched):
+        try:
+            connection = await asyncpg.connect(**connect_kwargs)
+            try:
+                async with connection.transaction(readonly=True):
+                    cursor = await connection.cursor(sql_query)
+                    while True:
+                        rows = await cursor.fetch(_batch_rows(batch_size))
+                        await fetched.put(rows)
+                        if not rows:
+                            break
+            finally:
+                await connection.close()
+        except Exception as e:
+            await fetched.put(e)
+
+    def convert(rows):
+        nonlocal types
+        with measure_stage("conversion"):
+            batch = _rows_to_record_batch(rows, columns, types)
+        types = _pinned_types(types, batch)
+        return batch
+
+    async def pipeline():
+        loop = asyncio.get_running_loop()
+        fetched = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+        fetcher = asyncio.create_task(fetch(fetched))
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                emitted = False
+                while not stopped.is_set():
+                    rows = await fetched.get()
+                    if isinstance(rows, Exception):
+                        raise rows
+                    if not rows and emitted:
+                        break
+                    batch = await loop.run_in_executor(executor, convert, rows)
+                    await loop.run_in_executor(
+                        executor, _put_until_stopped, batches, batch, stopped
+                    )
+                    emitted = True
+                    if not rows:
+                        break
+        finally:
+            fetcher.cancel()
+            await asyncio.gather(fetcher, return_exceptions=True)
+
+    def run():
+        try:
+            asyncio.run(pipeline())
+            _put_until_stopped(batches, None, stopped)
+        except Exception as e:
+            _put_until_stopped(batches, e, stopped)
+
+    logger.info("Fetching query results asynchronously...")
+    runner = threading.Thread(target=run, name="async-pipeline", daemon=True)
+    runner.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        runner.join()
+
+
+class PgBinaryDecoder:
+    """
+    Incremental decoder for the PostgreSQL binary COPY format.
+
+    Field values are collected per column as raw bytes and only converted when
+    a batch is flushed, one column at a time, so fixed-width types are decoded
+    with a single NumPy call instead of one Python object per value.
+    """
+
+    FIXED_WIDTH_TYPES = {
+        PG_BOOL: "?",
+        PG_INT2: ">i2",
+        PG_INT4: ">i4",
+        PG_INT8: ">i8",
+        PG_FLOAT4: ">f4",
+        PG_FLOAT8: ">f8",
+        PG_DATE: ">i4",
+        PG_TIMESTAMP: ">i8",
+        PG_TIMESTAMPTZ: ">i8",
+    }
+    TEXT_TYPES = (PG_TEXT, PG_VARCHAR, PG_BPCHAR, PG_NAME, PG_JSON, PG_JSONB)
+    SUPPORTED_TYPES = set(FIXED_WIDTH_TYPES) | set(TEXT_TYPES) | {PG_NUMERIC, PG_UUID}
+
+    _INT16 = struct.Struct(">h")
+    _INT32 = struct.Struct(">i")
+
+    def __init__(self, fields, batch_size, dictionary_columns=()):
+        """
+        Args:
+            fields (list): `(name, type_oid, precision, scale)` for each column.
+            batch_size (int or BatchSizer): Number of rows per flushed batch.
+            dictionary_columns (Iterable[str]): Text columns to dictionary-encode.
+        """
+        self.fields = fields
+        self.batch_size = batch_size
+        dictionary_columns = set(dictionary_columns or ())
+        self.schema = pa.schema(
+            [
+                pa.field(
+                    name,
+                    _dictionary_type(
+                        name, _pg_arrow_type(oid, precision, scale), dictionary_columns
+                    ),
+                )
+                for name, oid, precision, scale in fields
+            ]
+        )
+        self._buffer = b""
+        self._header_read = False
+        self._columns = [[] for _ in fields]
+        self._rows = 0
+        self.done = False
+
+    def feed(self, data):
+        """
+        Decode a chunk of the COPY stream.
+
+        Args:
+            data (bytes): Next chunk of the stream, split at any byte boundary.
+
+        Returns:
+            list: Record batches completed by this chunk.
+        """
+        buffer = self._buffer + bytes(data)
+        size = len(buffer)
+        pos = 0
+        if not self._header_read:
+            if size < 19:
+                self._buffer = buffer
+                return []
+            if buffer[:11] != PGCOPY_SIGNATURE:
+                raise ValueError("Invalid binary COPY signature")
+            header_end = 19 + self._INT32.unpack_from(buffer, 15)[0]
+            if size < header_end:
+                self._buffer = buffer
+                return []
+            pos = header_end
+            self._header_read = True
+
+        batches = []
+        batch_rows = _batch_rows(self.batch_size)
+        field_count = len(self._columns)
+        unpack_int16 = self._INT16.unpack_from
+        unpack_int32 = self._INT32.unpack_from
+        appends = [column.append for column in self._columns]
+        while pos + 2 <= size:
+            row_start = pos
+            (count,) = unpack_int16(buffer, pos)
+            pos += 2
+            if count == -1:
+                self.done = True
+                break
+            if count != field_count:
+                raise ValueError(f"Expected {field_count} fields, got {count}")
+            decoded = 0
+            for append in appends:
+                if pos + 4 > size:
+                    break
+                (length,) = unpack_int32(buffer, pos)
+                pos += 4
+                if length == -1:
+                    append(None)
+                else:
+                    end = pos + length
+                    if end > size:
+                        break
+                    append(buffer[pos:end])
+                    pos = end
+                decoded += 1
+            else:
+                self._rows += 1
+                if self._rows >= batch_rows:
+                    batches.append(self.flush())
+                    appends = [column.append for column in self._columns]
+                continue
+            # The row continues in the next chunk: undo the partial row.
+            for column in self._columns[:decoded]:
+                column.pop()
+            pos = row_start
+            break
+        self._buffer = buffer[pos:]
+        return batches
+
+    def flush(self):
+        """
+        Convert the rows collected so far into a record batch.
+
+        Returns:
+            pyarrow.RecordBatch: Decoded rows, possibly empty.
+        """
+        arrays = []
+        for values, (_, oid, _, _), field in zip(
+            self._columns, self.fields, self.schema
+        ):
+            if pa.types.is_dictionary(field.type):
+                column = _decode_pg_column(values, oid, field.type.value_type)
+                arrays.append(column.dictionary_encode())
+            else:
+                arrays.append(_decode_pg_column(values, oid, field.type))
+        self._columns = [[] for _ in self.fields]
+        self._rows = 0
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+class _CopyBatchSink:
+    """
+    File-like target for `copy_expert` that feeds the COPY stream to a decoder.
+
+    psycopg2 writes one row at a time, so data is buffered into larger chunks
+    before decoding. Completed batches are handed to the consumer queue.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, decoder, batches, stopped):
+        self._decoder = decoder
+        self._batches = batches
+        self._stopped = stopped
+        self._chunks = []
+        self._buffered = 0
+
+    def write(self, data):
+        if self._stopped.is_set():
+            raise RuntimeError("COPY consumer stopped")
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.CHUNK_SIZE:
+            self._drain()
+        return len(data)
+
+    def close(self):
+        self._drain()
+        with measure_stage("conversion"):
+            batch = self._decoder.flush()
+        _put_until_stopped(self._batches, batch, self._stopped)
+
+    def _drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        with measure_stage("conversion"):
+            batches = self._decoder.feed(data)
+        for batch in batches:
+            _put_until_stopped(self._batches, batch, self._stopped)
+
+
+def _put_until_stopped(items, item, stopped):
+    """Put an item on a bounded queue unless the consumer has gone away."""
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _strip_sql(sql_query):
+    """Strip whitespace and trailing semicolons so the query can be nested."""
+    return sql_query.strip().rstrip(";").strip()
+
+
+def _quote_ident(name):
+    """Quote a SQL identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _pg_arrow_type(oid, precision=None, scale=None):
+    """
+    Map a PostgreSQL type OID to the Arrow type produced by the COPY decoder.
+
+    Numerics with a declared precision become `decimal128`; unconstrained
+    numerics are kept as text so that no digits are lost.
+    """
+    if oid == PG_BOOL:
+        return pa.bool_()
+    if oid == PG_INT2:
+        return pa.int16()
+    if oid == PG_INT4:
+        return pa.int32()
+    if oid == PG_INT8:
+        return pa.int64()
+    if oid == PG_FLOAT4:
+        return pa.float32()
+    if oid == PG_FLOAT8:
+        return pa.float64()
+    if oid == PG_DATE:
+        return pa.date32()
+    if oid == PG_TIMESTAMP:
+        return pa.timestamp("us")
+    if oid == PG_TIMESTAMPTZ:
+        return pa.timestamp("us", tz="UTC")
+    if oid == PG_NUMERIC and precision and 0 < precision <= 38:
+        return pa.decimal128(precision, scale or 0)
+    return pa.string()
+
+
+def _decode_pg_column(values, oid, arrow_type):
+    """
+    Decode the raw binary values of one column into an Arrow array.
+
+    Args:
+        values (list): Raw field bytes, or None for NULL.
+        oid (int): PostgreSQL type OID of the column.
+        arrow_type (pyarrow.DataType): Target Arrow type.
+
+    Returns:
+        pyarrow.Array: Decoded column.
+    """
+    # Columns without NULLs take the fast path through C-level joins and maps.
+    null_count = values.count(None)
+    if null_count:
+        valid = np.array([value is not None for value in values], dtype=bool)
+    else:
+        valid = np.ones(len(values), dtype=bool)
+    dtype = PgBinaryDecoder.FIXED_WIDTH_TYPES.get(oid)
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        if null_count:
+            padding = bytes(dtype.itemsize)
+            values = [value if value is not None else padding for value in values]
+        data = b"".join(values)
+        numbers = np.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder("="))
+        if oid in (PG_DATE, PG_TIMESTAMP, PG_TIMESTAMPTZ):
+            # +/-infinity are stored as the extreme integers and have no Arrow equivalent.
+            limits = np.iinfo(numbers.dtype)
+            valid &= (numbers != limits.max) & (numbers != limits.min)
+            numbers = numbers + (
+                PG_EPOCH_DAYS if oid == PG_DATE else PG_EPOCH_MICROS
+            ) * valid.astype(numbers.dtype)
+        mask = ~valid if not valid.all() else None
+        return pa.array(numbers, mask=mask).cast(arrow_type)
+    if oid in PgBinaryDecoder.TEXT_TYPES:
+        if oid == PG_JSONB:
+            # Binary jsonb values are prefixed with a one byte format version.
+            values = [value[1:] if value is not None else None for value in values]
+        return _string_array_from_values(values, valid, null_count)
+    if oid == PG_UUID:
+        return _uuid_array_from_values(values, valid, null_count)
+    if oid == PG_NUMERIC:
+        if pa.types.is_decimal(arrow_type):
+            return _decimal_array_from_values(values, valid, arrow_type)
+        return pa.array([_pg_numeric_text(value) for value in values], type=pa.string())
+    raise ValueError(f"Unsupported type OID: {oid}")
+
+
+def _string_array_from_values(values, valid, null_count):
+    """Build an Arrow string array directly from UTF-8 encoded values."""
+    present = [value for value in values if value is not None] if null_count else values
+    lengths = np.zeros(len(values), dtype=np.int64)
+    lengths[valid] = np.fromiter(map(len, present), dtype=np.int64, count=len(present))
+    data = b"".join(present)
+    large = len(data) >= 2**31
+    offsets = np.zeros(len(values) + 1, dtype=np.int64 if large else np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    validity = (
+        pa.py_buffer(np.packbits(valid, bitorder="little")) if null_count else None
+    )
+    array_type = pa.LargeStringArray if large else pa.StringArray
+    array = array_type.from_buffers(
+        len(values), pa.py_buffer(offsets), pa.py_buffer(data), validity, null_count
+    )
+    return array.cast(pa.string()) if large else array
+
+
+def _uuid_array_from_values(values, valid, null_count):
+    """Format 16-byte UUID values as their canonical text in a single pass."""
+    if null_count:
+        padding = bytes(16)
+        values = [value if value is not None else padding for value in values]
+    digits = np.frombuffer(b"".join(values).hex().encode(), dtype="S1")
+    text = np.full((len(values), 36), b"-", dtype="S1")
+    digits = digits.reshape(len(values), 32)
+    for start, end, offset in (
+        (0, 8, 0),
+        (8, 12, 1),
+        (12, 16, 2),
+        (16, 20, 3),
+        (20, 32, 4),
+    ):
+        text[:, start + offset : end + offset] = digits[:, start:end]
+    offsets = np.arange(0, 36 * len(values) + 1, 36, dtype=np.int32)
+    validity = (
+        pa.py_buffer(np.packbits(valid, bitorder="little")) if null_count else None
+    )
+    return pa.StringArray.from_buffers(
+        len(values),
+        pa.py_buffer(offsets),
+        pa.py_buffer(text.tobytes()),
+        validity,
+        null_count,
+    )
+
+
+def _decimal_array_from_values(values, valid, arrow_type):
+    """
+    Build an Arrow decimal128 array from binary numerics.
+
+    Each value is converted to its unscaled integer at the scale of the column
+    and written as 16 little-endian bytes, without building Decimal objects.
+    """
+    padding = bytes(16)
+    scale = arrow_type.scale
+    valid = valid.copy()
+    data = []
+    for index, value in enumerate(values):
+        parts = _pg_numeric_parts(value)
+        if parts is None:
+            # NaN and infinities have no decimal equivalent and become NULL.
+            valid[index] = False
+            data.append(padding)
+            continue
+        negative, magnitude, exponent, _ = parts
+        exponent += scale
+        if exponent >= 0:
+            magnitude *= 10**exponent
+        else:
+            magnitude //= 10**-exponent
+        data.append(
+            (-magnitude if negative else magnitude).to_bytes(16, "little", signed=True)
+        )
+    null_count = len(values) - int(valid.sum())
+    validity = (
+        pa.py_buffer(np.packbits(valid, bitorder="little")) if null_count else None
+    )
+    return pa.Array.from_buffers(
+        arrow_type, len(values), [validity, pa.py_buffer(b"".join(data))], null_count
+    )
+
+
+def _pg_numeric_text(value):
+    """
+    Format a binary PostgreSQL numeric with its display scale.
+
+    Returns:
+        str: Decimal text, or None for NULL, NaN and infinities.
+    """
+    parts = _pg_numeric_parts(value)
+    if parts is None:
+        return None
+    negative, magnitude, exponent, dscale = parts
+    exponent += dscale
+    if exponent >= 0:
+        magnitude *= 10**exponent
+    else:
+        magnitude //= 10**-exponent
+    digits = str(magnitude).rjust(dscale + 1, "0")
+    if dscale:
+        digits = f"{digits[:-dscale]}.{digits[-dscale:]}"
+    return f"-{digits}" if negative else digits
+
+
+def _pg_numeric_parts(value):
+    """
+    Split a binary PostgreSQL numeric into sign, digits and exponent.
+
+    The value is `magnitude * 10 ** exponent`, displayed with `dscale`
+    fractional digits.
+
+    Returns:
+        tuple: `(negative, magnitude, exponent, dscale)`, or None for NULL,
+        NaN and infinities.
+    """
+    if value is None:
+        return None
+    ndigits, weight, sign, dscale = struct.unpack_from(">hhHh", value)
+    if sign not in (0x0000, 0x4000):
+        return None
+    magnitude = 0
+    for group in struct.unpack_from(f">{ndigits}H", value, 8):
+        magnitude = magnitude * 10000 + group
+    return sign == 0x4000, magnitude, (weight - ndigits + 1) * 4, dscale
+
+
+def parquet_writer_kwargs(options):
+    """
+    Build the Parquet writer arguments chosen in the export options.
+
+    Only the options that are set are included, so an empty dict means the
+    library defaults.
+
+    Args:
+        options (dict): Export options from `load_export_options`, or None.
+
+    Returns:
+        dict: Keyword arguments for `pyarrow.parquet.ParquetWriter`.
+    """
+    if not options:
+        return {}
+    kwargs = {}
+    for option, argument in (
+        ("parquet_compression", "compression"),
+        ("parquet_compression_level", "compression_level"),
+        ("parquet_dictionary", "use_dictionary"),
+        ("parquet_statistics", "write_statistics"),
+    ):
+        if options[option] is not None:
+            kwargs[argument] = options[option]
+    return kwargs
+
+
+def _custom_parquet_options(options):
+    """Return the Parquet options that differ from the defaults, for logging."""
+    if not options:
+        return {}
+    return {
+        name: value
+        for name, value in options.items()
+        if name.startswith("parquet_") and value is not None
+    }
+
+
+def _row_group_rows(options, batch):
+    """
+    Return the configured number of rows per row group, or None for one per batch.
+
+    A size in megabytes is converted with the in-memory size of `batch`.
+    """
+    if not options:
+        return None
+    if options["parquet_row_group_rows"]:
+        return options["parquet_row_group_rows"]
+    if options["parquet_row_group_mb"]:
+        bytes_per_row = max(batch.nbytes / max(batch.num_rows, 1), 1)
+        return max(
+            int(options["parquet_row_group_mb"] * 1024 * 1024 / bytes_per_row), 1
+        )
+    return None
+
+
+def _sort_rows(data, options):
+    """Sort a record batch or table on the configured sort keys, if any."""
+    if options and options["parquet_sort_by"]:
+        return data.sort_by(options["parquet_sort_by"])
+    return data
+
+
+def _write_parquet_batches(batches, where, options=None, on_row_group=None):
+    """
+    Write record batches to a Parquet file.
+
+    Each batch becomes one row group, unless a row group size is configured,
+    in which case batches are buffered and regrouped to that size. Rows are
+    sorted within each row group when sort keys are configured.
+
+    The file schema is fixed when the writer opens, so while a column of an
+    inferred type has only been NULL, batches are held back (up to
+    `NULL_TYPE_BUFFER_MB`) until a value gives the column its type.
+
+    With `validate_output`, the distinct values of each column are counted
+    per row group and stored in the footer metadata under
+    `PARQUET_DISTINCT_COUNTS_KEY`, for the statistics index.
+
+    `on_row_group`, when given, is called with each row group once it is
+    written.
+
+    Returns:
+        int: Number of rows written.
+    """
+    writer = None
+    group_rows = None
+    pending = []
+    pending_rows = 0
+    held = []
+    schema = None
+    rows = 0
+    distinct_counts = [] if options and options.get("validate_output") else None
+
+    def write_row_group(data):
+        if distinct_counts is not None:
+            distinct_counts.append(_distinct_counts(data))
+        if isinstance(data, pa.Table):
+            writer.write_table(data, row_group_size=data.num_rows)
+        else:
+            writer.write_batch(data)
+        if on_row_group is not None:
+            on_row_group(data)
+
+    def write_group(table):
+        write_row_group(_sort_rows(table, options))
+
+    def open_writer():
+        nonlocal writer, group_rows
+        group_rows = _row_group_rows(options, held[0])
+        sorting_columns = None
+        if options and options["parquet_sort_by"]:
+            sorting_columns = pq.SortingColumn.from_ordering(
+                schema, options["parquet_sort_by"]
+            )
+        writer = pq.ParquetWriter(
+            where,
+            schema,
+            sorting_columns=sorting_columns,
+            **parquet_writer_kwargs(options),
+        )
+
+    def write(batch):
+        nonlocal pending, pending_rows
+        if batch.schema != writer.schema:
+            untyped = [
+                field.name
+                for field, other in zip(writer.schema, batch.schema)
+                if pa.types.is_null(field.type) and not pa.types.is_null(other.type)
+            ]
+            if untyped:
+                raise ValueError(
+                    f"Column {', '.join(untyped)} was NULL in the first "
+                    f"{NULL_TYPE_BUFFER_MB} MB of rows, so its type is unknown. "
+                    "Cast it to a type in the query"
+                )
+            batch = batch.cast(writer.schema)
+        if group_rows is None:
+            write_row_group(_sort_rows(batch, options))
+            return
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= group_rows:
+            table = pa.Table.from_batches(pending)
+            write_group(table.slice(0, group_rows))
+            rest = table.slice(group_rows)
+            pending = rest.to_batches()
+            pending_rows = rest.num_rows
+
+    def release():
+        open_writer()
+        for item in held:
+            write(item.cast(schema) if item.schema != schema else item)
+        held.clear()
+
+    try:
+        for batch in batches:
+            rows += batch.num_rows
+            if writer is not None:
+                write(batch)
+                continue
+            held.append(batch)
+            schema = _typed_schema(schema, batch.schema)
+            if (
+                not any(pa.types.is_null(t) for t in schema.types)
+                or sum(item.nbytes for item in held)
+                >= NULL_TYPE_BUFFER_MB * 1024 * 1024
+            ):
+                release()
+        if held:
+            release()
+        if pending_rows:
+            write_group(pa.Table.from_batches(pending))
+        if distinct_counts is not None and writer is not None:
+            writer.add_key_value_metadata(
+                {PARQUET_DISTINCT_COUNTS_KEY: json.dumps(distinct_counts)}
+            )
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _distinct_counts(data):
+    """Count the distinct non-null values of each column of a row group."""
+    counts = {}
+    for name, column in zip(data.schema.names, data.columns):
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        try:
+            counts[name] = pc.count_distinct(column, mode="only_valid").as_py()
+        except pa.ArrowNotImplementedError:
+            # Nested columns cannot be hashed and keep the footer estimate.
+            counts[name] = None
+    return counts
+
+
+def _typed_schema(schema, other):
+    """Give the null-typed fields of a schema the type they have in another one."""
+    if schema is None:
+        return other
+    return pa.schema(
+        [
+            candidate if pa.types.is_null(field.type) else field
+            for field, candidate in zip(schema, other)
+        ]
+    )
+
+
+@metered("write_to_s3_or_local")
+def write_batches_to_s3_or_local(
+    batches, staging, file_name, path, options=None, progress=None
+):
+    """
+    Write a stream of record batches to either Amazon S3 or local storage.
+
+    Batches are written incrementally so memory stays bounded by the batch
+    size. For S3 the Parquet bytes are streamed into a multipart upload as
+    parts fill up (see `S3MultipartWriter`), so neither the full file nor a
+    spool file on the Lambda temporary storage is needed.
+
+    Args:
+        batches (Iterable[pyarrow.RecordBatch]): Data to be written.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output file.
+        path (str): Storage path.
+        options (dict): Export options with the Parquet writer settings.
+        progress (callable): Optional callback given the Arrow size of each
+            row group once it is written, and the size of the file so far.
+
+    Returns:
+        int: Number of rows written.
+    """
+    output_path = os.path.join(path, file_name)
+    try:
+        logger.info(f"Writing result batches to {output_path}...")
+        logger.info(
+            f"Parquet options: {_custom_parquet_options(options) or 'defaults'}"
+        )
+        if staging:
+            os.makedirs(path or ".", exist_ok=True)
+
+            def written(data):
+                progress(data.nbytes, os.path.getsize(output_path))
+
+            try:
+                rows = _write_parquet_batches(
+                    batches, output_path, options, written if progress else None
+                )
+            except Exception:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise
+            size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        else:
+            options = options or {}
+            with S3MultipartWriter(
+                output_path,
+                part_size=int(
+                    options.get("s3_part_size_mb", DEFAULT_S3_PART_SIZE_MB)
+                    * 1024
+                    * 1024
+                ),
+                max_in_flight=options.get("s3_max_in_flight", DEFAULT_S3_MAX_IN_FLIGHT),
+            ) as sink:
+
+                def written(data):
+                    progress(data.nbytes, sink.tell())
+
+                rows = _write_parquet_batches(
+                    batches, sink, options, written if progress else None
+                )
+            size = sink.tell()
+        logger.info(f"Parquet file size: {size} bytes")
+        record_stage_metrics("write_to_s3_or_local", rows=rows, bytes_written=size)
+        logger.info(f"Result written to {output_path} ({rows} rows)")
+        return rows
+    except Exception as e:
+        return handle_error(f"Error writing data: {e}")
+
+
+def write_sharded_batches(batches, staging, file_name, path, options):
+    """
+    Write a stream of record batches as Parquet parts of bounded size.
+
+    `file_name` becomes a prefix. Batches are dealt in turn to `shard_writers`
+    parts that are written at the same time, each on its own thread and, on
+    S3, its own multipart upload. A part is closed once it holds
+    `max_file_rows` rows or about `max_file_size_mb` of Parquet data, and its
+    writer starts a new one. The size counts the bytes the part's writer has
+    written, plus the batches still queued for it at the compression ratio
+    of the row groups written so far, once there are any. Parts are named `part-<run>-NNNNN.parquet` and
+    published by writing `<file_name>/_manifest.json` with their row counts
+    and the schema, after which the parts of the previous export are removed.
+
+    Args:
+        batches (Iterable[pyarrow.RecordBatch]): Data to be written.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        int: Number of rows written.
+    """
+    root = os.path.join(path, file_name)
+    run_id = uuid.uuid4().hex[:8]
+    max_rows = options["max_file_rows"]
+    max_bytes = (options["max_file_size_mb"] or 0) * 1024 * 1024
+    stopped = threading.Event()
+    lock = threading.Lock()
+    totals = {"arrow": 0, "bytes": 0}
+    slots = [None] * options["shard_writers"]
+    parts = []
+    failures = []
+    schema = None
+
+    def write_part(file, items, written):
+        def queued():
+            while True:
+                try:
+                    item = items.get(timeout=0.1)
+                except queue.Empty:
+                    if stopped.is_set():
+                        raise RuntimeError("another part failed")
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        def progress(arrow_bytes, file_bytes):
+            with lock:
+                totals["arrow"] += arrow_bytes
+                totals["bytes"] += file_bytes - written["bytes"]
+                written["arrow"] += arrow_bytes
+                written["bytes"] = file_bytes
+
+        rows = write_batches_to_s3_or_local(
+            queued(), staging, file, root, options, progress
+        )
+        if is_error_response(rows):
+            failures.append(rows)
+            stopped.set()
+        return rows
+
+    def part_bytes(slot):
+        with lock:
+            written = dict(slot["written"])
+            ratio = totals["bytes"] / totals["arrow"] if totals["arrow"] else 0
+        if written["arrow"]:
+            ratio = written["bytes"] / written["arrow"]
+        return written["bytes"] + (slot["arrow"] - written["arrow"]) * ratio
+
+    def close(index, item=None):
+        _put_until_stopped(slots[index]["items"], item, stopped)
+        slots[index] = None
+
+    try:
+        logger.info(
+            f"Writing result batches to {root} in parts of at most "
+            f"{max_rows or 'any'} rows and {options['max_file_size_mb'] or 'any'} MB, "
+            f"{len(slots)} at a time..."
+        )
+        with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+            try:
+                for turn, batch in enumerate(batches):
+                    if schema is None:
+                        schema = batch.schema
+                    elif batch.num_rows == 0:
+                        continue
+                    index = turn % len(slots)
+                    while not stopped.is_set():
+                        if slots[index] is None:
+                            file = f"part-{run_id}-{len(parts):05d}.parquet"
+                            items = queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+                            written = {"arrow": 0, "bytes": 0}
+                            parts.append(
+                                (
+                                    file,
+                                    executor.submit(write_part, file, items, written),
+                                )
+                            )
+                            slots[index] = {
+                                "items": items,
+                                "rows": 0,
+                                "arrow": 0,
+                                "written": written,
+                            }
+                        slot = slots[index]
+                        piece = (
+                            batch.slice(0, max_rows - slot["rows"])
+                            if max_rows
+                            else batch
+                        )
+                        _put_until_stopped(slot["items"], piece, stopped)
+                        slot["rows"] += piece.num_rows
+                        slot["arrow"] += piece.nbytes
+                        if (max_rows and slot["rows"] >= max_rows) or (
+                            max_bytes and part_bytes(slot) >= max_bytes
+                        ):
+                            close(index)
+                        batch = batch.slice(piece.num_rows)
+                        if batch.num_rows == 0:
+                            break
+                    if stopped.is_set():
+                        break
+            except Exception as e:
+                # Abort the open parts, so no partial upload is completed.
+                for index, slot in enumerate(slots):
+                    if slot is not None:
+                        close(index, e)
+                raise
+            for index, slot in enumerate(slots):
+                if slot is not None:
+                    close(index)
+
+        results = [future.result() for _, future in parts]
+        if failures:
+            _delete_parts(staging, root, [file for file, _ in parts])
+            return failures[0]
+        files = [
+            {"file": file, "rows": rows} for (file, _), rows in zip(parts, results)
+        ]
+        result = _write_manifest(
+            staging,
+            root,
+            files,
+            schema=_schema_fields(schema),
+        )
+        if is_error_response(result):
+            _delete_parts(staging, root, [file for file, _ in parts])
+            return result
+        _remove_parquet_parts(staging, root, keep=[part["file"] for part in files])
+        rows = sum(results)
+        logger.info(f"Result written to {root} ({rows} rows in {len(files)} parts)")
+        return rows
+    except Exception as e:
+        _delete_parts(staging, root, [file for file, _ in parts])
+        return handle_error(f"Error writing data: {e}")
+
+
+def plan_partitions(conn, sql_query, options):
+    """
+    Split a SQL query into disjoint slices on the configured partition column.
+
+    Range partitioning reads the minimum and maximum of the column and cuts
+    that range into `partition_count` half-open intervals. NULLs go to the
+    first slice. ctid partitioning cuts the heap of `partition_table` into
+    block ranges instead, and requires the query to select the `ctid` column
+    of that table.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to split.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        list: SQL query of each slice.
+    """
+    try:
+        logger.info("Planning partitions...")
+        sql_query = _strip_sql(sql_query)
+        column = options["partition_column"]
+        count = options["partition_count"]
+        quoted = f"q.{_quote_ident(column)}"
+        with conn.cursor() as curs:
+            if column == "ctid":
+                curs.execute(
+                    "SELECT pg_relation_size(%s::regclass) "
+                    "/ current_setting('block_size')::int",
+                    (options["partition_table"],),
+                )
+                (blocks,) = curs.fetchone()
+                bounds = [f"({blocks * i // count},0)" for i in range(1, count)]
+                cast = "::tid"
+            else:
+                curs.execute(
+                    f"SELECT min({quoted}), max({quoted}) FROM (\n{sql_query}\n) AS q"
+                )
+                lower, upper = curs.fetchone()
+                if lower is None:
+                    return [sql_query]
+                bounds = _split_range(lower, upper, count)
+                cast = ""
+
+            base = f"SELECT * FROM (\n{sql_query}\n) AS q".replace("%", "%%")
+            edges = [None] + list(dict.fromkeys(bounds)) + [None]
+            slices = []
+            for low, high in zip(edges, edges[1:]):
+                conditions = []
+                params = []
+                if low is not None:
+                    conditions.append(f"{quoted} >= %s{cast}")
+                    params.append(low)
+                if high is not None:
+                    conditions.append(f"{quoted} < %s{cast}")
+                    params.append(high)
+                condition = " AND ".join(conditions) or "TRUE"
+                if low is None and column != "ctid":
+                    condition = f"({condition} OR {quoted} IS NULL)"
+                slices.append(
+                    curs.mogrify(f"{base} WHERE {condition}", params).decode()
+                )
+        logger.info(f"Query split into {len(slices)} partitions on {column}")
+        return slices
+    except Exception as e:
+        return handle_error(f"Partition planning error: {e}")
+
+
+def _split_range(lower, upper, count):
+    """Cut the range between two numbers, dates or timestamps into `count` parts."""
+    if isinstance(lower, str):
+        raise ValueError("Range partitioning needs a numeric or temporal column")
+    if isinstance(lower, int):
+        return [lower + (upper - lower) * i // count for i in range(1, count)]
+    return [lower + (upper - lower) * i / count for i in range(1, count)]
+
+
+def export_partitions(
+    db_params, slices, staging, file_name, path, options, tracker=None, snapshot=None
+):
+    """
+    Export query slices in parallel, one connection and one Parquet part per slice.
+
+    Parts are written as `part-<run>-NNNNN.parquet` under a prefix named after
+    the output file. The parts of the previous export are only removed once
+    every slice has been written; if a slice fails, the new parts are deleted
+    and the previous output is left as it was.
+
+    Args:
+        db_params (tuple): Arguments for `connect_to_db`.
+        slices (list): SQL query of each slice, from `plan_partitions`.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+        tracker (WatermarkTracker): Optional tracker observing the exported rows.
+        snapshot (str): Optional snapshot from `export_snapshot` that every
+            slice reads.
+
+    Returns:
+        int: Total number of rows written.
+    """
+    prefix = os.path.join(path, file_name)
+    run_id = uuid.uuid4().hex[:8]
+    files = [f"part-{run_id}-{index:05d}.parquet" for index in range(len(slices))]
+    drop_column = "ctid" if options["partition_column"] == "ctid" else None
+
+    def export_slice(index, slice_query):
+        conn = acquire_connection(db_params, snapshot)
+        if is_error_response(conn):
+            return conn
+        try:
+            batches = extract_batches(conn, slice_query, options)
+            if drop_column:
+                batches = _drop_column(batches, drop_column)
+            if tracker is not None:
+                batches = tracker.observe(batches)
+            return write_batches_to_s3_or_local(
+                batches, staging, files[index], prefix, options
+            )
+        finally:
+            release_connection(conn, db_params)
+
+    try:
+        logger.info(f"Exporting {len(slices)} partitions to {prefix}...")
+        with ThreadPoolExecutor(max_workers=len(slices)) as executor:
+            results = list(executor.map(export_slice, range(len(slices)), slices))
+        for result in results:
+            if is_error_response(result):
+                _delete_parts(staging, prefix, files)
+                return result
+        _remove_parquet_parts(staging, prefix, keep=files)
+        rows = sum(results)
+        logger.info(f"{len(slices)} partitions written to {prefix} ({rows} rows)")
+        return rows
+    except Exception as e:
+        _delete_parts(staging, prefix, files)
+        return handle_error(f"Partition export error: {e}")
+
+
+def _drop_column(batches, name):
+    """Remove a helper column from every record batch."""
+    for batch in batches:
+        if name in batch.schema.names:
+            batch = batch.drop_columns([name])
+        yield batch
+
+
+def _remove_parquet_parts(staging, prefix, keep=()):
+    """Delete the `part-*.parquet` files left under an output prefix, except `keep`."""
+    keep = set(keep)
+    if staging:
+        if os.path.isdir(prefix):
+            for entry in os.listdir(prefix):
+                if (
+                    entry.startswith("part-")
+                    and entry.endswith(".parquet")
+                    and entry not in keep
+                ):
+                    os.remove(os.path.join(prefix, entry))
+    else:
+        bucket, key = _split_s3_path(f"{prefix}/part-")
+        client = _s3_client()
+        pages = client.get_paginator("list_objects_v2").paginate(
+            Bucket=bucket, Prefix=key
+        )
+        for page in pages:
+            parts = [
+                {"Key": item["Key"]}
+                for item in page.get("Contents", ())
+                if item["Key"].endswith(".parquet")
+                and "/" not in item["Key"][len(key) :]
+                and os.path.basename(item["Key"]) not in keep
+            ]
+            if parts:
+                client.delete_objects(
+                    Bucket=bucket, Delete={"Objects": parts, "Quiet": True}
+                )
+
+
+def _delete_parts(staging, prefix, files):
+    """Delete the given part files under an output prefix, if they exist."""
+    if staging:
+        for file in files:
+            location = os.path.join(prefix, file)
+            if os.path.exists(location):
+                os.remove(location)
+        return
+    bucket, key = _split_s3_path(prefix)
+    client = _s3_client()
+    for start in range(0, len(files), 1000):
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [
+                    {"Key": f"{key}/{file}"} for file in files[start : start + 1000]
+                ],
+                "Quiet": True,
+            },
+        )
+
+
+def export_query(
+    conn,
+    db_params,
+    sql_query,
+    staging,
+    file_name,
+    path,
+    options,
+    tracker=None,
+    snapshot=None,
+):
+    """
+    Export the result of a SQL query with the configured extraction mode.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        db_params (tuple): Arguments for `connect_to_db`.
+        sql_query (str): SQL query to execute.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output file.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+        tracker (WatermarkTracker): Optional tracker observing the exported rows.
+            When set, an empty result writes no file.
+        snapshot (str): Optional snapshot from `export_snapshot` for the
+            connections of partitioned exports.
+
+    Returns:
+        int: Number of rows written.
+    """
+    if options["partition_column"]:
+        slices = plan_partitions(conn, sql_query, options)
+        if is_error_response(slices):
+            return slices
+        return export_partitions(
+            db_params, slices, staging, file_name, path, options, tracker, snapshot
+        )
+
+    if options["extract_mode"] != "pandas":
+        batches = extract_batches(conn, sql_query, options)
+        if tracker is not None:
+            first = next(batches, None)
+            if first is None or first.num_rows == 0:
+                logger.info("No new rows to export")
+                return 0
+            batches = tracker.observe(itertools.chain([first], batches))
+        if options["output_partition_cols"]:
+            return write_dataset_to_s3_or_local(
+                batches, staging, file_name, path, options
+            )
+        if options["max_file_size_mb"] or options["max_file_rows"]:
+            return write_sharded_batches(batches, staging, file_name, path, options)
+        return write_batches_to_s3_or_local(batches, staging, file_name, path, options)
+
+    query_result = query_database(conn, sql_query, *db_params)
+    if is_error_response(query_result):
+        return query_result
+    if tracker is not None:
+        if query_result.empty:
+            logger.info("No new rows to export")
+            return 0
+        tracker.observe_frame(query_result)
+    if options["output_partition_cols"]:
+        return write_dataset_to_s3_or_local(
+            query_result, staging, file_name, path, options
+        )
+    if options["max_file_size_mb"] or options["max_file_rows"]:
+        table = pa.Table.from_pandas(query_result, preserve_index=False)
+        return write_sharded_batches(
+            table.to_batches(max_chunksize=options["batch_size"]),
+            staging,
+            file_name,
+            path,
+            options,
+        )
+    result = write_to_s3_or_local(query_result, staging, file_name, path, options)
+    if is_error_response(result):
+        return result
+    return len(query_result)
+
+
+def export_resumable(conn, sql_query, staging, file_name, path, options):
+    """
+    Export a query in key order as parts that survive a failed invocation.
+
+    Rows are read ordered by `checkpoint_column`, which must be unique, and
+    written as parts of about `target_file_size_mb` under the hidden
+    `<file_name>/_checkpoints/<job_id>/` prefix. After each part, the
+    checkpoint `<file_name>/_checkpoints/<job_id>.json` records the part and
+    the last key written. A later run with the same job id resumes after that
+    key instead of starting over. The checkpoint also records the Arrow schema
+    of the parts, and a part that does not match it, for instance because the
+    table changed between two runs, fails the export instead of being added.
+    Once all rows are written, the parts are moved to
+    `<file_name>/part-<run>-NNNNN.parquet` and published at once by writing
+    `<file_name>/_manifest.json` with their schema, then the parts of the
+    previous export and the checkpoint are removed.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to execute.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        int: Total number of rows exported, across the resumed runs.
+    """
+    column = options["checkpoint_column"]
+    job_id = options["job_id"] or os.path.splitext(file_name)[0]
+    root = os.path.join(path, file_name)
+    parts_dir = os.path.join(root, "_checkpoints", job_id)
+    checkpoint_location = os.path.join(root, "_checkpoints", f"{job_id}.json")
+    try:
+        state = read_json_state(staging, checkpoint_location)
+        if is_error_response(state):
+            return state
+        if state is None:
+            state = {
+                "job_id": job_id,
+                "run_id": uuid.uuid4().hex[:8],
+                "column": column,
+                "last_key": None,
+                "rows": 0,
+                "parts": [],
+            }
+            logger.info(f"Starting resumable export {job_id}")
+        elif state["column"] != column:
+            raise ValueError(f"Checkpoint was recorded for column {state['column']}")
+        elif state.get("phase") == "committing":
+            logger.info(f"Finishing the interrupted commit of export {job_id}")
+            return _commit_checkpoint(
+                staging, root, parts_dir, checkpoint_location, state
+            )
+        else:
+            logger.info(
+                f"Resuming export {job_id} after {column} = {state['last_key']} "
+                f"({state['rows']} rows in {len(state['parts'])} parts)"
+            )
+
+        batches = extract_batches(
+            conn, _resume_query(conn, sql_query, column, state["last_key"]), options
+        )
+        part_bytes = options["target_file_size_mb"] * 1024 * 1024
+
+        def interrupted(error):
+            return handle_error(
+                f"Export {job_id} interrupted with {state['rows']} rows "
+                f"checkpointed, run it again to resume: {error}"
+            )
+
+        while True:
+            try:
+                first = next(batches, None)
+            except Exception as e:
+                return interrupted(e)
+            if first is None or (first.num_rows == 0 and state["parts"]):
+                break
+            part = {"file": f"part-{len(state['parts']):05d}.parquet"}
+
+            def part_batches(batch=first):
+                size = 0
+                while batch is not None:
+                    if batch.num_rows:
+                        part["last_key"] = batch.column(column)[-1].as_py()
+                    size += batch.nbytes
+                    yield batch
+                    if size >= part_bytes:
+                        return
+                    batch = next(batches, None)
+
+            rows = write_batches_to_s3_or_local(
+                part_batches(), staging, part["file"], parts_dir, options
+            )
+            if is_error_response(rows):
+                return interrupted(rows["body"].removeprefix("Error: "))
+            metadata = _read_parquet_footer(
+                staging, os.path.join(parts_dir, part["file"])
+            )
+            fields = _schema_fields(metadata.schema.to_arrow_schema())
+            schema = _merge_schema_fields(state.get("schema", fields), fields)
+            if schema is None:
+                return handle_error(
+                    f"Part {part['file']} of export {job_id} does not have the "
+                    "schema of the parts already checkpointed. Delete "
+                    f"{checkpoint_location} to start over"
+                )
+            state["schema"] = schema
+            state["parts"].append({"file": part["file"], "rows": rows})
+            state["rows"] += rows
+            if "last_key" in part:
+                value = part["last_key"]
+                state["last_key"] = (
+                    value.isoformat() if hasattr(value, "isoformat") else str(value)
+                )
+            result = write_json_state(staging, checkpoint_location, state)
+            if is_error_response(result):
+                return result
+            if first.num_rows == 0:
+                break
+
+        return _commit_checkpoint(staging, root, parts_dir, checkpoint_location, state)
+    except Exception as e:
+        return handle_error(f"Resumable export error: {e}")
+
+
+def _resume_query(conn, sql_query, column, last_key):
+    """Order a query by its checkpoint column, after the last exported key if any."""
+    sql_query = _strip_sql(sql_query).replace("%", "%%")
+    where = "" if last_key is None else f" WHERE q.{_quote_ident(column)} > %s"
+    with conn.cursor() as curs:
+        return curs.mogrify(
+            f"SELECT * FROM (\n{sql_query}\n) AS q{where} "
+            f"ORDER BY q.{_quote_ident(column)}",
+            () if last_key is None else (last_key,),
+        ).decode()
+
+
+def _commit_checkpoint(staging, root, parts_dir, checkpoint_location, state):
+    """
+    Publish the parts of a finished resumable export.
+
+    The manifest is the single write that switches readers to the new parts,
+    so they never see a mix of two exports through it. The final part names
+    are recorded in the checkpoint before any part moves, so a commit that is
+    interrupted is finished by the next run, which skips the parts already
+    moved.
+    """
+    if state.get("phase") != "committing":
+        state["phase"] = "committing"
+        state["files"] = [
+            f"part-{state['run_id']}-{index:05d}.parquet"
+            for index in range(len(state["parts"]))
+        ]
+        result = write_json_state(staging, checkpoint_location, state)
+        if is_error_response(result):
+            return result
+    files = state["files"]
+    logger.info(f"Committing {len(files)} parts to {root}...")
+    for part, final in zip(state["parts"], files):
+        target = os.path.join(root, final)
+        if output_exists(staging, target):
+            continue
+        _move_object(staging, os.path.join(parts_dir, part["file"]), target)
+    result = _write_manifest(
+        staging,
+        root,
+        [
+            {"file": final, "rows": part["rows"]}
+            for part, final in zip(state["parts"], files)
+        ],
+        job_id=state["job_id"],
+        schema=state.get("schema", []),
+    )
+    if is_error_response(result):
+        return result
+    _remove_parquet_parts(staging, root, keep=files)
+    if staging:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.remove(checkpoint_location)
+        try:
+            os.rmdir(os.path.dirname(checkpoint_location))
+        except OSError:
+            pass  # Checkpoints of other jobs are still in progress
+    else:
+        # Sources left by a copy that was interrupted before its delete.
+        _delete_parts(staging, parts_dir, [part["file"] for part in state["parts"]])
+        bucket, key = _split_s3_path(checkpoint_location)
+        _s3_client().delete_object(Bucket=bucket, Key=key)
+    logger.info(f"Export {state['job_id']} committed ({state['rows']} rows)")
+    return state["rows"]
+
+
+def _write_manifest(staging, root, files, **fields):
+    """
+    Write `<root>/_manifest.json`, listing the parts of an export with their rows.
+
+    Readers can plan their splits from the manifest without listing the
+    prefix, and since it is a single write it switches them to a new set of
+    parts at once.
+    """
+    return write_json_state(
+        staging,
+        os.path.join(root, "_manifest.json"),
+        {
+            **fields,
+            "files": files,
+            "rows": sum(part["rows"] for part in files),
+            "committed_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+
+
+def _schema_fields(schema):
+    """Describe the fields of an Arrow schema for a JSON manifest or index."""
+    return [
+        {"name": field.name, "type": str(field.type), "nullable": field.nullable}
+        for field in schema or ()
+    ]
+
+
+def _merge_schema_fields(recorded, fields):
+    """
+    Check that two schema descriptions from `_schema_fields` match.
+
+    A column that was only NULL so far takes the type it has in the other
+    description.
+
+    Returns:
+        list: The merged description, or None if the columns or types differ.
+    """
+    if [field["name"] for field in recorded] != [field["name"] for field in fields]:
+        return None
+    merged = []
+    for old, new in zip(recorded, fields):
+        if old["type"] != new["type"] and "null" not in (old["type"], new["type"]):
+            return None
+        merged.append(new if old["type"] == "null" else old)
+    return merged
+
+
+def _move_object(staging, source, target):
+    """Move a file locally, or an object within S3 with a server-side copy."""
+    if staging:
+        os.replace(source, target)
+        return
+    source_bucket, source_key = _split_s3_path(source)
+    bucket, key = _split_s3_path(target)
+    client = _s3_client()
+    client.copy_object(
+        Bucket=bucket,
+        Key=key,
+        CopySource={"Bucket": source_bucket, "Key": source_key},
+        **S3_ADDITIONAL_KWARGS,
+    )
+    client.delete_object(Bucket=source_bucket, Key=source_key)
+
+
+def export_changes(conn, staging, file_name, path, options):
+    """
+    Export the row changes captured by a logical replication slot.
+
+    The changes are peeked from the slot with the `pgoutput` plugin, which
+    publishes the tables of `cdc_publication`, and written as one Parquet
+    file per table under `<file_name>/<schema>.<table>/`, named after the
+    first and last LSN it holds. Each row carries the `_lsn`, `_xid` and
+    `_op` (`I`, `U`, `D` or `T`) of the change next to the table columns.
+    The slot is only advanced past the exported transactions once every file
+    is written, so a failed run exports the same changes again. The slot is
+    created on the first run, which captures changes from then on.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        int: Number of changes written.
+    """
+    slot = options["cdc_slot"]
+    root = os.path.join(path, file_name)
+    try:
+        with conn.cursor() as curs:
+            curs.execute(
+                "SELECT plugin FROM pg_replication_slots WHERE slot_name = %s",
+                (slot,),
+            )
+            row = curs.fetchone()
+            if row is None:
+                curs.execute(
+                    "SELECT pg_create_logical_replication_slot(%s, %s)",
+                    (slot, CDC_PLUGIN),
+                )
+                conn.commit()
+                logger.info(f"Created replication slot {slot}, capturing changes")
+                return 0
+            if row[0] != CDC_PLUGIN:
+                raise ValueError(f"Replication slot {slot} uses the {row[0]} plugin")
+
+        logger.info(f"Reading changes from replication slot {slot}...")
+        decoder = PgOutputDecoder()
+        with conn.cursor(name="postgres2parquet_changes") as curs:
+            curs.itersize = _batch_rows(options["batch_size"])
+            curs.execute(
+                "SELECT lsn::text, data FROM pg_logical_slot_peek_binary_changes("
+                "%s, NULL, %s, 'proto_version', '1', 'publication_names', %s)",
+                (slot, options["cdc_max_changes"], options["cdc_publication"]),
+            )
+            for lsn, data in curs:
+                decoder.feed(lsn, bytes(data))
+        if decoder.commit_lsn is None:
+            logger.info("No new changes to export")
+            return 0
+
+        rows = 0
+        for (schema, table), batch in decoder.batches():
+            lsns = batch.column("_lsn")
+            part = f"changes-{lsns[0].as_py():016X}-{lsns[-1].as_py():016X}.parquet"
+            result = write_batches_to_s3_or_local(
+                iter([batch]),
+                staging,
+                part,
+                os.path.join(root, f"{schema}.{table}"),
+                options,
+            )
+            if is_error_response(result):
+                return result
+            rows += result
+
+        with conn.cursor() as curs:
+            # Confirm the changes only once every file is written.
+            curs.execute(
+                "SELECT pg_replication_slot_advance(%s, %s::pg_lsn)",
+                (slot, decoder.commit_lsn),
+            )
+        conn.commit()
+        logger.info(f"{rows} changes exported, slot {slot} at {decoder.commit_lsn}")
+        return rows
+    except Exception as e:
+        return handle_error(f"Change export error: {e}")
+
+
+class PgOutputDecoder:
+    """
+    Decoder for the messages of the `pgoutput` logical decoding plugin.
+
+    Relation messages describe the columns of each table, and the insert,
+    update, delete and truncate messages that follow are collected as change
+    rows per table and column layout. Protocol version 1 sends the values as
+    text, which are converted with the same type mapping as the COPY decoder.
+    Updates keep the new row and deletes the old key or row. Unchanged TOAST
+    values are not sent by PostgreSQL and become NULL.
+    """
+
+    def __init__(self):
+        self.relations = {}
+        self.changes = {}
+        self.xid = None
+        self.commit_lsn = None
+
+    def feed(self, lsn, data):
+        """Decode one message, given with the LSN reported by the slot."""
+        kind = data[:1]
+        if kind == b"B":
+            (self.xid,) = struct.unpack_from(">I", data, 17)
+        elif kind == b"C":
+            # The LSN of a commit is the end of its transaction.
+            self.commit_lsn = lsn
+        elif kind == b"R":
+            (relid,) = struct.unpack_from(">I", data, 1)
+            schema, offset = self._read_string(data, 5)
+            table, offset = self._read_string(data, offset)
+            (count,) = struct.unpack_from(">h", data, offset + 1)
+            offset += 3
+            columns = []
+            for _ in range(count):
+                name, offset = self._read_string(data, offset + 1)
+                oid, typmod = struct.unpack_from(">Ii", data, offset)
+                offset += 8
+                columns.append((name, oid, typmod))
+            self.relations[relid] = (schema or "pg_catalog", table, tuple(columns))
+        elif kind in (b"I", b"U", b"D"):
+            (relid,) = struct.unpack_from(">I", data, 1)
+            offset = 5
+            while offset < len(data):
+                marker = data[offset : offset + 1]
+                values, offset = self._read_tuple(data, offset + 1)
+                if marker == b"N" or kind == b"D":
+                    row = values
+            self._add(relid, lsn, kind.decode(), row)
+        elif kind == b"T":
+            (count,) = struct.unpack_from(">I", data, 1)
+            for relid in struct.unpack_from(f">{count}I", data, 6):
+                self._add(relid, lsn, "T", [None] * len(self.relations[relid][2]))
+        # Type, origin and other messages carry no rows.
+
+    def batches(self):
+        """
+        Build the collected changes into record batches.
+
+        Yields:
+            tuple: `(schema, table)` and a `pyarrow.RecordBatch` of its changes,
+            in LSN order.
+        """
+        for (schema, table, columns), rows in self.changes.items():
+            values = list(zip(*rows))
+            arrays = [
+                pa.array([_parse_lsn(lsn) for lsn in values[0]], pa.int64()),
+                pa.array(values[1], pa.int64()),
+                pa.array(values[2], pa.string()),
+            ] + [
+                _text_to_arrow(column_values, oid, typmod, name)
+                for column_values, (name, oid, typmod) in zip(values[3:], columns)
+            ]
+            names = ["_lsn", "_xid", "_op"] + [name for name, _, _ in columns]
+            yield (schema, table), pa.RecordBatch.from_arrays(arrays, names=names)
+
+    def _add(self, relid, lsn, op, values):
+        self.changes.setdefault(self.relations[relid], []).append(
+            (lsn, self.xid, op, *values)
+        )
+
+    @staticmethod
+    def _read_string(data, offset):
+        end = data.index(b"\x00", offset)
+        return data[offset:end].decode(), end + 1
+
+    @staticmethod
+    def _read_tuple(data, offset):
+        (count,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        values = []
+        for _ in range(count):
+            kind = data[offset : offset + 1]
+            offset += 1
+            if kind == b"t":
+                (length,) = struct.unpack_from(">i", data, offset)
+                offset += 4
+                values.append(data[offset : offset + length].decode())
+                offset += length
+            else:
+                values.append(None)  # NULL, or an unchanged TOAST value
+        return values, offset
+
+
+def _parse_lsn(lsn):
+    """Convert an LSN in its `X/Y` text form to an integer."""
+    high, _, low = lsn.partition("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+def _text_to_arrow(values, oid, typmod, name=None):
+    """
+    Convert the text form of PostgreSQL values into an Arrow array.
+
+    The column always gets the type of its OID, so every change file of a
+    table has the same schema. Values that do not parse as that type, such
+    as infinite timestamps, become NULL and are counted in a warning.
+    """
+    text = pa.array(values, pa.string())
+    if oid == PG_BOOL:
+        return pc.equal(text, "t")
+    precision = scale = None
+    if oid == PG_NUMERIC and typmod >= 4:
+        precision, scale = (typmod - 4) >> 16, (typmod - 4) & 0xFFFF
+    arrow_type = _pg_arrow_type(oid, precision, scale)
+    try:
+        return text.cast(arrow_type)
+    except pa.ArrowInvalid:
+        pass
+    parsed = []
+    invalid = []
+    for value in values:
+        try:
+            parsed.append(pa.array([value], pa.string()).cast(arrow_type)[0])
+        except pa.ArrowInvalid:
+            parsed.append(None)
+            invalid.append(value)
+    logger.warning(
+        f"{len(invalid)} values of column {name or oid} are not valid "
+        f"{arrow_type} and were written as NULL, such as {invalid[0]!r}"
+    )
+    return pa.array(parsed, arrow_type)
+
+
+class WatermarkTracker:
+    """
+    Track the highest value of the watermark column across exported rows.
+
+    Batches may be observed from several threads when the export is
+    partitioned, so updates are serialized with a lock.
+    """
+
+    def __init__(self, column):
+        self.column = column
+        self.value = None
+        self._lock = threading.Lock()
+
+    def observe(self, batches):
+        """Yield the batches unchanged while recording the column maximum."""
+        for batch in batches:
+            if batch.num_rows:
+                self._update(pc.max(batch.column(self.column)).as_py())
+            yield batch
+
+    def observe_frame(self, data):
+        """Record the column maximum of a DataFrame."""
+        value = data[self.column].max()
+        self._update(None if pd.isna(value) else value)
+
+    def state(self, file_name, rows):
+        """
+        Build the state object persisted after a successful export.
+
+        The watermark is stored as text so that PostgreSQL casts it back to
+        the column type when it is compared in the next run.
+        """
+        value = self.value
+        if hasattr(value, "isoformat"):
+            value = value.isoformat()
+        return {
+            "column": self.column,
+            "watermark": str(value),
+            "file_name": file_name,
+            "rows": rows,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def _update(self, value):
+        if value is None:
+            return
+        with self._lock:
+            if self.value is None or value > self.value:
+                self.value = value
+
+
+def watermark_state_location(path, file_name):
+    """
+    Get the location of the watermark state object stored next to the output.
+
+    Args:
+        path (str): Storage path.
+        file_name (str): Name of the output file.
+
+    Returns:
+        str: Path or S3 URI of the state object.
+    """
+    stem = os.path.splitext(file_name)[0]
+    return os.path.join(path, f"{stem}.watermark.json")
+
+
+def dated_file_name(file_name):
+    """
+    Add the current UTC time to a file name so each incremental run writes a new part.
+
+    Args:
+        file_name (str): Name of the output file.
+
+    Returns:
+        str: File name such as `export-20240101T120000Z.parquet`.
+    """
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}{extension}"
+
+
+def apply_watermark(conn, sql_query, column, state):
+    """
+    Restrict a SQL query to the rows past the last exported watermark.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to restrict.
+        column (str): Monotonically increasing column, such as `updated_at` or `id`.
+        state (dict): State object saved by the previous run, or None for the first run.
+
+    Returns:
+        str: SQL query returning only the new rows.
+    """
+    try:
+        if state is None:
+            logger.info(f"No watermark yet for {column}, exporting all rows")
+            return sql_query
+        if state["column"] != column:
+            raise ValueError(
+                f"Watermark state was recorded for column {state['column']}"
+            )
+        logger.info(f"Exporting rows with {column} > {state['watermark']}")
+        sql_query = _strip_sql(sql_query).replace("%", "%%")
+        with conn.cursor() as curs:
+            return curs.mogrify(
+                f"SELECT * FROM (\n{sql_query}\n) AS q "
+                f"WHERE q.{_quote_ident(column)} > %s",
+                (state["watermark"],),
+            ).decode()
+    except Exception as e:
+        return handle_error(f"Watermark error: {e}")
+
+
+def event_selection(source):
+    """Pick the `columns`, `filters` and `limit` given by an event or a job."""
+    return {key: source[key] for key in SELECTION_KEYS if key in source}
+
+
+def apply_selection(conn, sql_query, selection, options):
+    """
+    Narrow a SQL query to the columns, filters and limit given by the event.
+
+    The query is wrapped as `SELECT <columns> FROM (<query>) AS q WHERE ...
+    LIMIT n`, so PostgreSQL does the projection and filtering and only the
+    selected data is sent. Columns must be returned by the query and are
+    quoted, operators come from `SELECTION_OPERATORS`, and values are bound
+    as parameters.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to narrow.
+        selection (dict): Optional `columns` list, `filters` list and `limit`.
+            A filter is `{"column": ..., "op": ..., "value": ...}` or a
+            `[column, op, value]` list, and `in` and `not in` take a list value.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        str: SQL query returning only the selected rows and columns.
+    """
+    try:
+        sql_query = _strip_sql(sql_query)
+        available = query_columns(conn, sql_query)
+        refreshed = False
+
+        def column_ref(name):
+            nonlocal available, refreshed
+            if isinstance(name, str) and name not in available and not refreshed:
+                # The cached description may predate a change of the query's tables.
+                available = query_columns(conn, sql_query, refresh=True)
+                refreshed = True
+            if not isinstance(name, str) or name not in available:
+                raise ValueError(f"Unknown column: {name}")
+            return f"q.{_quote_ident(name)}"
+
+        columns = selection.get("columns")
+        if columns is None:
+            projection = "*"
+        else:
+            columns = list(dict.fromkeys(_parse_list(columns)))
+            if not columns:
+                raise ValueError("columns must not be empty")
+            required = [
+                options["partition_column"],
+                options["watermark_column"],
+                options["checkpoint_column"],
+                *options["output_partition_cols"],
+                *(column for column, _ in options["parquet_sort_by"] or ()),
+            ]
+            projection = ", ".join(column_ref(name) for name in columns)
+            missing = [name for name in required if name and name not in columns]
+            if missing:
+                raise ValueError(f"columns must include {', '.join(missing)}")
+
+        conditions = []
+        params = []
+        filters = selection.get("filters") or []
+        if not isinstance(filters, list):
+            raise ValueError("filters must be a list")
+        for item in filters:
+            condition, values = _selection_condition(item, column_ref)
+            conditions.append(condition)
+            params.extend(values)
+
+        sql = f"SELECT {projection} FROM (\n{sql_query}\n) AS q".replace("%", "%%")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        limit = selection.get("limit")
+        if limit is not None:
+            if isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+                raise ValueError(f"Invalid limit: {limit}")
+            for name in ("partition_column", "watermark_column", "checkpoint_column"):
+                if options[name]:
+                    raise ValueError(f"limit cannot be combined with {name.upper()}")
+            sql += " LIMIT %s"
+            params.append(limit)
+
+        logger.info(
+            f"Selecting {len(columns) if columns else 'all'} columns "
+            f"with {len(conditions)} filters"
+            + (f" and a limit of {limit} rows" if limit is not None else "")
+        )
+        with conn.cursor() as curs:
+            return curs.mogrify(sql, params).decode()
+    except Exception as e:
+        return handle_error(f"Invalid selection: {e}")
+
+
+def _selection_condition(item, column_ref):
+    """Build the SQL condition and parameters of one selection filter."""
+    if isinstance(item, dict):
+        unknown = set(item) - {"column", "op", "value"}
+        if unknown:
+            raise ValueError(f"Unknown filter key: {', '.join(sorted(unknown))}")
+        column, op, value = item.get("column"), item.get("op", "="), item.get("value")
+    elif isinstance(item, list) and len(item) in (2, 3):
+        column, op, value = (*item, None)[:3]
+    else:
+        raise ValueError(f"Invalid filter: {item!r}")
+    operator = SELECTION_OPERATORS.get(str(op).strip().lower())
+    if operator is None:
+        raise ValueError(f"Invalid filter operator: {op}")
+    ref = column_ref(column)
+    if operator.endswith("NULL"):
+        return f"{ref} {operator}", []
+    if operator.endswith("IN"):
+        if (
+            not isinstance(value, list)
+            or not value
+            or not all(isinstance(v, (str, int, float)) for v in value)
+        ):
+            raise ValueError(f"Filter {op} on {column} needs a list of values")
+        return f"{ref} {operator} %s", [tuple(value)]
+    if not isinstance(value, (str, int, float)):
+        raise ValueError(f"Filter {op} on {column} needs a value")
+    return f"{ref} {operator} %s", [value]
+
+
+def query_description(conn, sql_query, refresh=False):
+    """
+    Get the cursor description of the columns returned by a SQL query.
+
+    The query is described by running it with `LIMIT 0`, which plans it
+    without reading rows. Descriptions are kept per database and query text
+    in a warm container, for the `QUERY_COLUMNS_CACHE_SIZE` most recently used
+    queries. A view or table can change under the same query text, so callers
+    that find a column missing describe the query again with `refresh`.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query, stripped of trailing semicolons.
+        refresh (bool): Describe the query even if a description is cached.
+
+    Returns:
+        list: A tuple per column in result order, laid out like
+        `cursor.description`.
+    """
+    key = (conn.dsn, sql_query)
+    with _QUERY_COLUMNS_LOCK:
+        description = None if refresh else _QUERY_COLUMNS.get(key)
+        if description is not None:
+            _QUERY_COLUMNS.move_to_end(key)
+    if description is not None:
+        logger.info("Reusing the cached query description")
+        return description
+    with conn.cursor() as curs:
+        curs.execute(f"SELECT * FROM (\n{sql_query}\n) AS q LIMIT 0")
+        description = [tuple(column) for column in curs.description]
+    with _QUERY_COLUMNS_LOCK:
+        _QUERY_COLUMNS[key] = description
+        _QUERY_COLUMNS.move_to_end(key)
+        while len(_QUERY_COLUMNS) > QUERY_COLUMNS_CACHE_SIZE:
+            _QUERY_COLUMNS.popitem(last=False)
+    return description
+
+
+def query_columns(conn, sql_query, refresh=False):
+    """
+    Get the names of the columns returned by a SQL query.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query, stripped of trailing semicolons.
+        refresh (bool): Describe the query even if a description is cached.
+
+    Returns:
+        list: Column names in result order.
+    """
+    return [column[0] for column in query_description(conn, sql_query, refresh)]
+
+
+_QUERY_COLUMNS = collections.OrderedDict()
+_QUERY_COLUMNS_LOCK = threading.Lock()
+
+
+def cache_state_location(path, file_name):
+    """
+    Get the location of the result cache state object stored next to the output.
+
+    Args:
+        path (str): Storage path.
+        file_name (str): Name of the output file.
+
+    Returns:
+        str: Path or S3 URI of the state object.
+    """
+    stem = os.path.splitext(file_name)[0]
+    return os.path.join(path, f"{stem}.cache.json")
+
+
+@metered("result_cache")
+def query_fingerprint(conn, sql_query, options):
+    """
+    Fingerprint a query and the current state of the tables it reads.
+
+    The tables are found in the query plan, so views and subqueries are
+    resolved to the relations actually scanned. Each table contributes cheap
+    change markers: its file node, which changes on TRUNCATE and rewrites,
+    and the inserted, updated and deleted tuple counters of
+    `pg_stat_all_tables`. When `cache_marker_column` is set, the maximum of
+    that column is added for every table where it leads a valid, non-partial
+    B-tree index, so reading it is a single index probe. Tables without such
+    an index rely on the counters alone, since the maximum would take a full
+    scan.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to fingerprint.
+        options (dict): Export options from `load_export_options`, which are
+            part of the fingerprint since they change the output.
+
+    Returns:
+        str: Hex digest that changes when the query, the options or the data change.
+    """
+    try:
+        sql_query = _strip_sql(sql_query)
+        with conn.cursor() as curs:
+            curs.execute(f"EXPLAIN (VERBOSE, FORMAT JSON) {sql_query}")
+            plan = curs.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            tables = sorted(_plan_relations(plan[0]["Plan"]))
+            markers = {}
+            if tables:
+                curs.execute(
+                    "SELECT c.oid::regclass::text, c.relfilenode, s.n_tup_ins, "
+                    "s.n_tup_upd, s.n_tup_del FROM pg_class c "
+                    "LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid "
+                    "WHERE c.oid = ANY(%s::regclass[])",
+                    (tables,),
+                )
+                for name, *counters in curs.fetchall():
+                    markers[name] = counters
+            column = options["cache_marker_column"]
+            if column and tables:
+                curs.execute(
+                    "SELECT a.attrelid::regclass::text, EXISTS ("
+                    "SELECT 1 FROM pg_index i "
+                    "JOIN pg_class ic ON ic.oid = i.indexrelid "
+                    "JOIN pg_am am ON am.oid = ic.relam "
+                    "WHERE i.indrelid = a.attrelid AND i.indkey[0] = a.attnum "
+                    "AND i.indisvalid AND i.indpred IS NULL "
+                    "AND am.amname = 'btree') "
+                    "FROM pg_attribute a "
+                    "WHERE a.attrelid = ANY(%s::regclass[]) AND a.attname = %s "
+                    "AND NOT a.attisdropped",
+                    (tables, column),
+                )
+                for name, indexed in curs.fetchall():
+                    if not indexed:
+                        logger.warning(
+                            f"{column} is not indexed on {name}, so only its "
+                            "statistics counters are compared"
+                        )
+                        continue
+                    curs.execute(f"SELECT max({_quote_ident(column)}) FROM {name}")
+                    markers[name].append(curs.fetchone()[0])
+        dsn = conn.get_dsn_parameters()
+        source = {key: dsn.get(key) for key in ("host", "port", "dbname")}
+        payload = json.dumps(
+            {
+                "source": source,
+                "sql": " ".join(sql_query.split()),
+                "tables": markers,
+                "options": options,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        fingerprint = hashlib.sha256(payload.encode()).hexdigest()
+        logger.info(f"Query fingerprint {fingerprint} ({len(tables)} tables)")
+        return fingerprint
+    except Exception as e:
+        return handle_error(f"Result cache error: {e}")
+
+
+def _plan_relations(node):
+    """Collect the quoted names of the relations scanned by a query plan node."""
+    relations = set()
+    if "Relation Name" in node:
+        relations.add(
+            f"{_quote_ident(node['Schema'])}.{_quote_ident(node['Relation Name'])}"
+        )
+    for child in node.get("Plans", ()):
+        relations |= _plan_relations(child)
+    return relations
+
+
+def plan_state_location(path, file_name):
+    """
+    Get the location of the query plan stored next to the output.
+
+    Args:
+        path (str): Storage path.
+        file_name (str): Name of the output file.
+
+    Returns:
+        str: Path or S3 URI of the plan object.
+    """
+    stem = os.path.splitext(file_name)[0]
+    return os.path.join(path, f"{stem}.plan.json")
+
+
+@metered("explain")
+def explain_query(conn, sql_query, options):
+    """
+    Explain a query and summarize the figures that decide how fast it exports.
+
+    In `plan` mode the query is only planned, so nothing is executed. In
+    `analyze` mode it runs once under `EXPLAIN (ANALYZE, BUFFERS)`, which adds
+    the actual rows, the timings and the shared buffer hits and reads, at the
+    cost of reading the data twice. Every sequential scan is listed with the
+    size of its table from `pg_class.reltuples`; those that read at least
+    `seq_scan_warn_rows` rows (the table size when the plan is not analyzed)
+    are logged as warnings.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query to explain.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        dict: The `summary` of the plan and the `plan` itself as returned by
+        PostgreSQL.
+    """
+    try:
+        mode = options["explain_mode"]
+        analyze = mode == "analyze"
+        flags = "ANALYZE, BUFFERS, VERBOSE" if analyze else "VERBOSE"
+        logger.info(f"Explaining the query ({mode})...")
+        with conn.cursor() as curs:
+            curs.execute(f"EXPLAIN ({flags}, FORMAT JSON) {_strip_sql(sql_query)}")
+            plan = curs.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            root = plan[0]["Plan"]
+            scans = [
+                node for node in _plan_nodes(root) if node["Node Type"] == "Seq Scan"
+            ]
+            names = [
+                f"{_quote_ident(node['Schema'])}.{_quote_ident(node['Relation Name'])}"
+                for node in scans
+            ]
+            table_rows = {}
+            if names:
+                curs.execute(
+                    "SELECT t.name, c.reltuples FROM unnest(%s::text[]) AS t(name) "
+                    "JOIN pg_class c ON c.oid = t.name::regclass",
+                    (sorted(set(names)),),
+                )
+                table_rows = dict(curs.fetchall())
+
+        summary = {
+            "mode": mode,
+            "total_cost": root["Total Cost"],
+            "estimated_rows": root["Plan Rows"],
+        }
+        if analyze:
+            summary.update(
+                {
+                    "actual_rows": _actual_rows(root),
+                    "planning_ms": plan[0].get("Planning Time"),
+                    "execution_ms": plan[0].get("Execution Time"),
+                    "shared_hit_blocks": root.get("Shared Hit Blocks"),
+                    "shared_read_blocks": root.get("Shared Read Blocks"),
+                }
+            )
+        seq_scans = []
+        warnings = []
+        threshold = options["seq_scan_warn_rows"]
+        for node, name in zip(scans, names):
+            # reltuples is -1 for a table that was never vacuumed or analyzed.
+            reltuples = table_rows.get(name)
+            scan = {
+                "relation": name,
+                "table_rows": int(reltuples) if reltuples and reltuples > 0 else None,
+                "estimated_rows": node["Plan Rows"],
+            }
+            if analyze:
+                scan["actual_rows"] = _actual_rows(node)
+                scan["rows_scanned"] = scan["actual_rows"] + int(
+                    node.get("Rows Removed by Filter", 0) * node["Actual Loops"]
+                )
+            scanned = scan["rows_scanned"] if analyze else scan["table_rows"]
+            if threshold and scanned is not None and scanned >= threshold:
+                warnings.append(
+                    f"Sequential scan of {name} reads {scanned} rows "
+                    f"(threshold {threshold})"
+                )
+            seq_scans.append(scan)
+        summary["seq_scans"] = seq_scans
+        summary["warnings"] = warnings
+        for warning in warnings:
+            logger.warning(warning)
+        logger.info(
+            f"Query plan: total cost {summary['total_cost']}, "
+            f"{len(seq_scans)} sequential scans"
+        )
+        return {"summary": summary, "plan": plan}
+    except Exception as e:
+        return handle_error(f"Explain error: {e}")
+
+
+def _plan_nodes(node):
+    """Yield a query plan node and all the nodes below it."""
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_nodes(child)
+
+
+def _actual_rows(node):
+    """Get the rows a plan node returned over all its loops."""
+    return int(round(node.get("Actual Rows", 0) * node.get("Actual Loops", 1)))
+
+
+def output_exists(staging, location):
+    """
+    Check whether an output file, or a prefix of parts, exists.
+
+    Args:
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        location (str): Path or S3 URI of the output.
+
+    Returns:
+        bool: True if the output exists.
+    """
+    if staging:
+        return os.path.exists(location)
+    bucket, key = _split_s3_path(location)
+    client = _s3_client()
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+        return True
+    except client.exceptions.ClientError:
+        response = client.list_objects_v2(Bucket=bucket, Prefix=f"{key}/", MaxKeys=1)
+        return response.get("KeyCount", 0) > 0
+
+
+def stats_state_location(path, file_name):
+    """
+    Get the location of the statistics index stored next to the output.
+
+    Args:
+        path (str): Storage path.
+        file_name (str): Name of the output file.
+
+    Returns:
+        str: Path or S3 URI of the index object.
+    """
+    stem = os.path.splitext(file_name)[0]
+    return os.path.join(path, f"{stem}.stats.json")
+
+
+@metered("validate_output")
+def validate_output(
+    conn, sql_query, staging, file_name, path, options, rows, index_name=None
+):
+    """
+    Check the written output against the export and index its statistics.
+
+    Only the Parquet footers are read: from local storage directly, and from
+    S3 with ranged GETs of the end of each object, run in parallel for
+    multi-part outputs. The row counts of the footers must add up to the rows
+    written, and every file must have the columns of the query, without the
+    Hive partition columns of a dataset, and the same Arrow schema. The
+    statistics index then lists each file and row group with the minimum,
+    maximum, null count and distinct estimate of every column, so readers
+    can skip files without opening them. When the index is named after
+    `index_name` rather than the output, as for the dated files of
+    incremental exports, the new files are added to those already indexed.
+
+    Args:
+        conn (psycopg2.extensions.connection): A PostgreSQL database connection.
+        sql_query (str): SQL query that was exported.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output file or prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+        rows (int): Number of rows written by the export.
+        index_name (str): Optional name the index is stored under instead of
+            `file_name`.
+
+    Returns:
+        dict: Number of files and rows checked, and the location of the index.
+    """
+    location = os.path.join(path, file_name)
+    try:
+        logger.info(f"Validating the Parquet footers of {location}...")
+        files = _list_parquet_files(staging, location)
+        with ThreadPoolExecutor(max_workers=DEFAULT_UPLOAD_CONCURRENCY) as executor:
+            footers = list(
+                executor.map(lambda file: _read_parquet_footer(staging, file[1]), files)
+            )
+        footer_rows = sum(metadata.num_rows for metadata in footers)
+        if footer_rows != rows:
+            raise ValueError(f"{footer_rows} rows in the files, {rows} rows written")
+
+        dropped = set(options["output_partition_cols"] or ())
+        if options["partition_column"] == "ctid":
+            dropped.add("ctid")
+
+        def expected_columns(refresh=False):
+            description = query_description(conn, _strip_sql(sql_query), refresh)
+            description = [column for column in description if column[0] not in dropped]
+            # The pandas mode keeps its own types, the batch modes those of the
+            # description, apart from columns whose type is inferred.
+            types = (
+                [None] * len(description)
+                if options["extract_mode"] == "pandas"
+                else arrow_types_from_description(
+                    description, options["dictionary_columns"]
+                )
+            )
+            return [column[0] for column in description], types
+
+        expected, expected_types = expected_columns()
+        refreshed = False
+        schema = None
+        for (name, _, _), metadata in zip(files, footers):
+            file_schema = metadata.schema.to_arrow_schema()
+            if file_schema.names != expected and not refreshed:
+                # The cached description may predate a change of the query's tables.
+                expected, expected_types = expected_columns(refresh=True)
+                refreshed = True
+            if file_schema.names != expected:
+                raise ValueError(
+                    f"{name} has the columns {', '.join(file_schema.names)}, "
+                    f"expected {', '.join(expected)}"
+                )
+            for field, expected_type in zip(file_schema, expected_types):
+                if expected_type is not None and field.type != expected_type:
+                    raise ValueError(
+                        f"{name} has {field.name} as {field.type}, "
+                        f"expected {expected_type}"
+                    )
+            if schema is None:
+                schema = file_schema
+            elif not file_schema.equals(schema):
+                raise ValueError(f"{name} has a different schema than {files[0][0]}")
+
+        index_location = stats_state_location(path, index_name or file_name)
+        entries = [
+            _file_statistics(name, size, metadata)
+            for (name, _, size), metadata in zip(files, footers)
+        ]
+        if index_name and index_name != file_name:
+            previous = read_json_state(staging, index_location)
+            if is_error_response(previous):
+                return previous
+            written = {entry["file"] for entry in entries}
+            entries = [
+                entry
+                for entry in (previous or {}).get("files", ())
+                if entry["file"] not in written
+            ] + entries
+        result = write_json_state(
+            staging,
+            index_location,
+            {
+                "rows": sum(entry["rows"] for entry in entries),
+                "schema": _schema_fields(schema),
+                "files": entries,
+                "indexed_at": datetime.now(timezone.utc).isoformat(),
+            },
+        )
+        if is_error_response(result):
+            return result
+        logger.info(f"Output validated ({len(files)} files, {rows} rows)")
+        return {"files": len(files), "rows": rows, "index": index_location}
+    except Exception as e:
+        return handle_error(f"Output validation error: {e}")
+
+
+def _list_parquet_files(staging, location):
+    """
+    List the Parquet files of an output, either a single file or a prefix.
+
+    Folders and files starting with `_` or `.`, such as checkpoints, are
+    skipped like query engines do.
+
+    Returns:
+        list: `(name, location, size)` of each file, with the name relative
+        to the prefix.
+    """
+    if staging:
+        if os.path.isfile(location):
+            return [(os.path.basename(location), location, os.path.getsize(location))]
+        files = []
+        for directory, folders, entries in os.walk(location):
+            folders[:] = sorted(
+                folder for folder in folders if not folder.startswith(("_", "."))
+            )
+            for entry in sorted(entries):
+                if entry.endswith(".parquet") and not entry.startswith(("_", ".")):
+                    local_file = os.path.join(directory, entry)
+                    files.append(
+                        (
+                            os.path.relpath(local_file, location),
+                            local_file,
+                            os.path.getsize(local_file),
+                        )
+                    )
+        return files
+    bucket, key = _split_s3_path(location)
+    client = _s3_client()
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+        return [(os.path.basename(key), location, response["ContentLength"])]
+    except client.exceptions.ClientError:
+        pass
+    files = []
+    pages = client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=f"{key}/"
+    )
+    for page in pages:
+        for item in page.get("Contents", ()):
+            name = item["Key"][len(key) + 1 :]
+            if name.endswith(".parquet") and not any(
+                segment.startswith(("_", ".")) for segment in name.split("/")
+            ):
+                files.append((name, f"s3://{bucket}/{item['Key']}", item["Size"]))
+    return sorted(files)
+
+
+def _read_parquet_footer(staging, location):
+    """
+    Read the metadata of a Parquet file without reading its data.
+
+    On S3 the last `PARQUET_FOOTER_READ_BYTES` of the object are fetched,
+    which holds the whole footer of most files, and the rest of a larger
+    footer with a second request.
+    """
+    if staging:
+        return pq.read_metadata(location)
+    bucket, key = _split_s3_path(location)
+    client = _s3_client()
+    tail = client.get_object(
+        Bucket=bucket, Key=key, Range=f"bytes=-{PARQUET_FOOTER_READ_BYTES}"
+    )["Body"].read()
+    if len(tail) < 12 or tail[-4:] != b"PAR1":
+        raise ValueError(f"{location} is not a Parquet file")
+    footer_size = int.from_bytes(tail[-8:-4], "little") + 8
+    if footer_size > len(tail):
+        tail = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{footer_size}")[
+            "Body"
+        ].read()
+    # The reader only needs the footer and the magic bytes around it.
+    return pq.read_metadata(pa.BufferReader(b"PAR1" + tail[-footer_size:]))
+
+
+def _file_statistics(name, size, metadata):
+    """Summarize the column statistics of a Parquet footer, per file and row group."""
+    paths = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+    counted = json.loads(
+        (metadata.metadata or {}).get(PARQUET_DISTINCT_COUNTS_KEY.encode(), b"null")
+    )
+    if not counted or len(counted) != len(groups):
+        counted = [{}] * len(groups)
+    chunks = [
+        [
+            _column_statistics(group.column(i), counts.get(path))
+            for i, path in enumerate(paths)
+        ]
+        for group, counts in zip(groups, counted)
+    ]
+    return {
+        "file": name,
+        "rows": metadata.num_rows,
+        "bytes": size,
+        "columns": {
+            path: _json_statistics(_merge_statistics([row[i] for row in chunks]))
+            for i, path in enumerate(paths)
+        },
+        "row_groups": [
+            {
+                "rows": group.num_rows,
+                "bytes": group.total_byte_size,
+                "columns": {
+                    path: _json_statistics(stats) for path, stats in zip(paths, row)
+                },
+            }
+            for group, row in zip(groups, chunks)
+        ],
+    }
+
+
+def _column_statistics(column, counted=None):
+    """
+    Read the statistics of a column chunk.
+
+    The distinct count is the one `counted` when the file was written, or the
+    one stored by some writers in the statistics. Otherwise it is estimated
+    from what the footer tells for sure: 0 when every value is null, 1 when
+    the minimum equals the maximum, and unknown otherwise.
+    """
+    stats = column.statistics
+    if stats is None:
+        return {
+            "min": None,
+            "max": None,
+            "null_count": None,
+            "distinct_count": counted,
+        }
+    minimum = stats.min if stats.has_min_max else None
+    maximum = stats.max if stats.has_min_max else None
+    null_count = stats.null_count if stats.has_null_count else None
+    if counted is not None:
+        distinct_count = counted
+    elif stats.has_distinct_count:
+        distinct_count = stats.distinct_count
+    elif null_count is not None and null_count == column.num_values:
+        distinct_count = 0
+    elif stats.has_min_max and minimum == maximum:
+        distinct_count = 1
+    else:
+        distinct_count = None
+    return {
+        "min": minimum,
+        "max": maximum,
+        "null_count": null_count,
+        "distinct_count": distinct_count,
+    }
+
+
+def _merge_statistics(chunks):
+    """Combine the statistics of the column chunks of one column of a file."""
+    if len(chunks) == 1:
+        return chunks[0]
+    # Row groups holding only nulls have no bounds, and do not widen them.
+    valued = [chunk for chunk in chunks if chunk["distinct_count"] != 0]
+    bounded = bool(valued) and all(chunk["min"] is not None for chunk in valued)
+    minimum = min(chunk["min"] for chunk in valued) if bounded else None
+    maximum = max(chunk["max"] for chunk in valued) if bounded else None
+    null_counts = [chunk["null_count"] for chunk in chunks]
+    counts = [chunk["distinct_count"] for chunk in valued]
+    if not valued:
+        distinct_count = 0
+    elif bounded and minimum == maximum:
+        distinct_count = 1
+    elif None not in counts:
+        # Row groups may share values, so their sum is an upper bound.
+        distinct_count = sum(counts)
+    else:
+        distinct_count = None
+    return {
+        "min": minimum,
+        "max": maximum,
+        "null_count": None if None in null_counts else sum(null_counts),
+        "distinct_count": distinct_count,
+    }
+
+
+def _json_statistics(stats):
+    """Make the bounds of column statistics JSON serializable."""
+    return {
+        **stats,
+        "min": _json_bound(stats["min"]),
+        "max": _json_bound(stats["max"]),
+    }
+
+
+def _json_bound(value):
+    """Keep binary bounds as text when they decode as UTF-8, and as hex otherwise."""
+    if isinstance(value, bytes):
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            return value.hex()
+    return value
+
+
+def read_json_state(staging, location):
+    """
+    Read a small JSON state object from S3 or local storage.
+
+    Args:
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        location (str): Path or S3 URI of the object.
+
+    Returns:
+        dict: The stored state, or None if the object does not exist yet.
+    """
+    try:
+        if staging:
+            if not os.path.exists(location):
+                return None
+            with open(location, "r") as state_file:
+                return json.load(state_file)
+        bucket, key = _split_s3_path(location)
+        try:
+            response = _s3_client().get_object(Bucket=bucket, Key=key)
+        except _s3_client().exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+    except Exception as e:
+        return handle_error(f"Error reading state {location}: {e}")
+
+
+def write_json_state(staging, location, state):
+    """
+    Write a small JSON state object to S3 or local storage.
+
+    Local files are replaced atomically, and S3 PUTs are atomic by nature.
+
+    Args:
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        location (str): Path or S3 URI of the object.
+        state (dict): JSON serializable state.
+
+    Returns:
+        None
+    """
+    try:
+        body = json.dumps(state, indent=2, default=str)
+        if staging:
+            temporary = f"{location}.tmp"
+            with open(temporary, "w") as state_file:
+                state_file.write(body)
+            os.replace(temporary, location)
+        else:
+            bucket, key = _split_s3_path(location)
+            _s3_client().put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body.encode(),
+                ContentType="application/json",
+            )
+        logger.info(f"State written to {location}")
+    except Exception as e:
+        return handle_error(f"Error writing state {location}: {e}")
+
+
+_S3_CLIENT = None
+
+
+def _s3_client():
+    """Get the boto3 S3 client, created once per container."""
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        _S3_CLIENT = boto3.client("s3")
+    return _S3_CLIENT
+
+
+def _split_s3_path(location):
+    """Split an S3 URI into its bucket and key."""
+    bucket, _, key = location.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+class S3MultipartWriter:
+    """
+    Writable file object that streams its content to S3 as a multipart upload.
+
+    Written bytes are buffered until a part is full, then uploaded on a thread
+    pool while writing continues. At most `max_in_flight` parts are queued or
+    uploading at any time, and writes block until a slot frees up, so memory
+    stays around `part_size * (max_in_flight + 1)`. Failed parts are retried,
+    and the upload is aborted if anything fails so that no partial object is
+    left behind. Content smaller than one part is written with a single PUT.
+    """
+
+    def __init__(
+        self,
+        path,
+        part_size=DEFAULT_S3_PART_SIZE_MB * 1024 * 1024,
+        max_in_flight=DEFAULT_S3_MAX_IN_FLIGHT,
+    ):
+        """
+        Args:
+            path (str): S3 URI of the object.
+            part_size (int): Size of each part in bytes, except the last one.
+            max_in_flight (int): Maximum number of parts queued or uploading.
+        """
+        self.path = path
+        self.bucket, self.key = _split_s3_path(path)
+        self.part_size = part_size
+        self.max_in_flight = max_in_flight
+        self.closed = False
+        self._client = _s3_client()
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._executor = None
+        self._parts = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        """
+        Buffer data and upload every part that is full.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed S3 upload")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def close(self):
+        """Upload the remaining bytes and complete the upload, or abort it on failure."""
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self._client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self._buffer),
+                    **S3_ADDITIONAL_KWARGS,
+                )
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self._client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+                logger.info(f"Uploaded {len(parts)} parts to {self.path}")
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def abort(self):
+        """Stop uploading and abort the multipart upload, if one was started."""
+        if self.closed:
+            return
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._upload_id is not None:
+            logger.warning(f"Aborting multipart upload to {self.path}")
+            self._client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+    def _submit(self, part):
+        """Queue one part for upload, waiting for a free in-flight slot."""
+        for future in self._parts:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **S3_ADDITIONAL_KWARGS
+            )
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight, thread_name_prefix="s3-part"
+            )
+        self._slots.acquire()
+        future = self._executor.submit(self._upload_part, len(self._parts) + 1, part)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, number, part):
+        """Upload one part, retrying with exponential backoff."""
+        for attempt in range(1, S3_PART_ATTEMPTS + 1):
+            try:
+                response = self._client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=number,
+                    Body=part,
+                )
+                return {"ETag": response["ETag"], "PartNumber": number}
+            except Exception as e:
+                if attempt == S3_PART_ATTEMPTS:
+                    raise
+                logger.warning(
+                    f"Retrying part {number} of {self.path} (attempt {attempt}): {e}"
+                )
+                time.sleep(S3_PART_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+@metered("write_to_s3_or_local")
+def write_dataset_to_s3_or_local(data, staging, file_name, path, options):
+    """
+    Write data as a Hive-partitioned Parquet dataset to Amazon S3 or local storage.
+
+    Files are laid out as `<file_name>/<col>=<value>/part-*.parquet`, rotating
+    to a new file once it reaches roughly `target_file_size_mb` of data.
+    `output_mode` controls existing data: `overwrite` replaces the whole
+    dataset, `append` adds files next to it, and `overwrite_partitions` only
+    replaces the partitions present in the new data. For S3 the dataset is
+    staged in the Lambda temporary storage, uploaded in parallel, and the
+    replaced objects are deleted after the upload.
+
+    Args:
+        data (pandas.DataFrame or Iterable[pyarrow.RecordBatch]): Data to be written.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the dataset prefix.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+
+    Returns:
+        int: Number of rows written.
+    """
+    root = os.path.join(path, file_name)
+    partition_cols = options["output_partition_cols"]
+    mode = options["output_mode"]
+    spool_dir = None
+    try:
+        logger.info(f"Writing partitioned dataset to {root} ({mode})...")
+        if _is_data_frame(data):
+            batches = pa.Table.from_pandas(data, preserve_index=False).to_batches()
+            data = iter(batches) if batches else iter([])
+        first = next(data, None)
+        if first is None:
+            logger.info("No rows to write")
+            return 0
+        missing = set(partition_cols) - set(first.schema.names)
+        if missing:
+            raise ValueError(f"Unknown partition column: {', '.join(sorted(missing))}")
+
+        bytes_per_row = max(first.nbytes / max(first.num_rows, 1), 1)
+        max_rows_per_file = max(
+            int(options["target_file_size_mb"] * 1024 * 1024 / bytes_per_row), 1
+        )
+        group_rows = _row_group_rows(options, first)
+        writer_kwargs = parquet_writer_kwargs(options)
+        logger.info(
+            f"Parquet options: {_custom_parquet_options(options) or 'defaults'}"
+        )
+        counter = {"rows": 0, "bytes": 0}
+
+        def counted(batches):
+            for batch in batches:
+                counter["rows"] += batch.num_rows
+                yield _sort_rows(batch, options)
+
+        def visit(written_file):
+            written.append(written_file.path)
+            counter["bytes"] += written_file.size
+
+        reader = pa.RecordBatchReader.from_batches(
+            first.schema, counted(itertools.chain([first], data))
+        )
+        base_dir = root if staging else tempfile.mkdtemp()
+        spool_dir = None if staging else base_dir
+        if staging and mode == "overwrite" and os.path.isdir(root):
+            shutil.rmtree(root)
+        written = []
+        ds.write_dataset(
+            reader,
+            base_dir,
+            format="parquet",
+            partitioning=partition_cols,
+            partitioning_flavor="hive",
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            file_options=(
+                ds.ParquetFileFormat().make_write_options(**writer_kwargs)
+                if writer_kwargs
+                else None
+            ),
+            max_rows_per_file=max_rows_per_file,
+            min_rows_per_group=min(max_rows_per_file, group_rows or 0),
+            max_rows_per_group=min(
+                max_rows_per_file, group_rows or DATASET_MAX_ROWS_PER_GROUP
+            ),
+            existing_data_behavior=(
+                "delete_matching"
+                if mode == "overwrite_partitions"
+                else "overwrite_or_ignore"
+            ),
+            file_visitor=visit,
+        )
+        if not staging:
+            _upload_dataset(base_dir, written, root, mode)
+        logger.info(
+            f"Dataset written to {root} ({counter['rows']} rows, {len(written)} files, "
+            f"{counter['bytes']} bytes)"
+        )
+        record_stage_metrics(
+            "write_to_s3_or_local",
+            rows=counter["rows"],
+            bytes_written=counter["bytes"],
+        )
+        return counter["rows"]
+    except Exception as e:
+        return handle_error(f"Error writing data: {e}")
+    finally:
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def _is_data_frame(data):
+    """Check for a DataFrame without importing pandas on the Arrow-only paths."""
+    pandas = sys.modules.get("pandas")
+    return pandas is not None and isinstance(data, pandas.DataFrame)
+
+
+def _upload_dataset(base_dir, files, root, mode):
+    """
+    Upload a dataset staged on local disk to S3, applying the output mode.
+
+    Objects replaced by the new data are listed before the upload and only
+    deleted once every new file is in place.
+    """
+    keys = [os.path.relpath(local_file, base_dir) for local_file in files]
+    if mode == "overwrite":
+        replaced = wr.s3.list_objects(f"{root}/")
+    elif mode == "overwrite_partitions":
+        partitions = {os.path.dirname(key) for key in keys}
+        replaced = [
+            old
+            for partition in sorted(partitions)
+            for old in wr.s3.list_objects(f"{root}/{partition}/")
+        ]
+    else:
+        replaced = []
+
+    def upload(local_file, key):
+        wr.s3.upload(
+            local_file=local_file,
+            path=f"{root}/{key}",
+            s3_additional_kwargs=S3_ADDITIONAL_KWARGS,
+        )
+
+    logger.info(f"Uploading {len(files)} dataset files to {root}...")
+    with ThreadPoolExecutor(max_workers=DEFAULT_UPLOAD_CONCURRENCY) as executor:
+        list(executor.map(upload, files, keys))
+    uploaded = {f"{root}/{key}" for key in keys}
+    replaced = [old for old in replaced if old not in uploaded]
+    if replaced:
+        logger.info(f"Deleting {len(replaced)} replaced dataset files...")
+        wr.s3.delete_objects(replaced)
+
+
+def write_to_s3_or_local(data, staging, file_name, path, options=None):
+    """
+    Write data to either Amazon S3 or local storage based on the testing flag.
+
+    When Parquet writer options are configured, the DataFrame is written
+    through the same Arrow writer as the batch path so that both paths apply
+    them identically. Otherwise awswrangler writes the DataFrame to S3 in one
+    piece, without the multipart streaming of the batch path.
+
+    Args:
+        data (pandas.DataFrame): Data to be written.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output file.
+        path (str): Storage path.
+        options (dict): Export options with the Parquet writer settings.
+
+    Returns:
+        None
+    """
+    if _custom_parquet_options(options):
+        with measure_stage("conversion"):
+            table = pa.Table.from_pandas(data, preserve_index=False)
+        batches = table.to_batches() or [
+            pa.RecordBatch.from_pylist([], schema=table.schema)
+        ]
+        result = write_batches_to_s3_or_local(
+            iter(batches), staging, file_name, path, options
+        )
+        return result if is_error_response(result) else None
+    try:
+        with measure_stage("write_to_s3_or_local"):
+            if not staging:
+                logger.info("Writing result to S3...")
+                # Write result to S3 when not in testing mode
+                wr.s3.to_parquet(
+                    df=data,
+                    path=os.path.join(path, file_name),
+                    s3_additional_kwargs=S3_ADDITIONAL_KWARGS,
+                )
+            else:
+                logger.info("Writing result to local storage...")
+                # Save the DataFrame to Parquet for local storage
+                print(
+                    os.path.join(path, file_name),
+                )
+                data.to_parquet(os.path.join(path, file_name), index=False)
+        output_file = os.path.join(path, file_name)
+        record_stage_metrics(
+            "write_to_s3_or_local",
+            rows=len(data) if isinstance(data, pd.DataFrame) else 0,
+            bytes_written=(
+                os.path.getsize(output_file) if os.path.isfile(output_file) else 0
+            ),
+        )
+
+        logger.info(f"Result written to {path + file_name}")
+    except Exception as e:
+        return handle_error(f"Error writing data: {e}")
+
+
+def handle_error(error):
+    """
+    Handle and log an error.
+
+    Parameters:
+    - error (str or Exception): The error message or exception to be logged.
+
+    Returns:
+    - dict: A dictionary containing an error response with a status code and error message.
+
+    This function logs the provided error message using the logger's error level
+    and returns an HTTP-like error response as a dictionary. It is typically used
+    in Lambda functions to handle and report errors.
+
+    Example:
+    If you call handle_error("An error occurred."), it logs the error and returns:
+    {"statusCode": 500, "body": "Error: An error occurred."}
+    """
+    logger.error(f"Error: {str(error)}")
+    return {"statusCode": 500, "body": f"Error: {str(error)}"}
+
+
+def is_error_response(result):
+    """
+    Check whether a step returned an error response built by `handle_error`.
+
+    Args:
+        result: Value returned by one of the export steps.
+
+    Returns:
+        bool: True if `result` is an error response dictionary.
+    """
+    return isinstance(result, dict) and result.get("statusCode") == 500
+
+
+def run_export(
+    db_params,
+    sql_query,
+    staging,
+    file_name,
+    path,
+    options,
+    report=None,
+    selection=None,
+    snapshot=None,
+):
+    """
+    Run one export on a pooled connection.
+
+    The query is first narrowed to the `selection` given by the event, if any.
+    With `cdc_slot` set, the changes captured by the replication slot are
+    exported instead of the query. With `result_cache` enabled, the export is skipped when the query
+    fingerprint matches the one stored with the existing output. With
+    `explain_mode` set, the query plan is stored next to the output before
+    the export runs. With `validate_output` enabled, the footers of the
+    written files are checked and indexed before any state advances. With a
+    `snapshot`, the export and its partitions read the data as of that
+    snapshot.
+
+    Args:
+        db_params (tuple): Arguments for `connect_to_db`.
+        sql_query (str): SQL query to export.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        file_name (str): Name of the output file.
+        path (str): Storage path.
+        options (dict): Export options from `load_export_options`.
+        report (dict): Optional dictionary receiving the result cache status
+            under `cache`, either `hit` or `miss`, the plan summary of
+            `explain_query` under `diagnostics`, and the result of
+            `validate_output` under `validation`.
+        selection (dict): Optional columns, filters and limit for `apply_selection`.
+        snapshot (str): Optional snapshot from `export_snapshot`.
+
+    Returns:
+        int: Number of rows written, or held by the cached output on a hit.
+    """
+    if snapshot:
+        # The pandas and async engines read on connections of their own,
+        # and change exports advance their slot in a write transaction.
+        if options["extract_mode"] not in ("stream", "copy"):
+            return handle_error(
+                "Invalid export option: a consistent snapshot requires the "
+                "stream or copy mode"
+            )
+        if options["cdc_slot"]:
+            return handle_error(
+                "Invalid export option: CDC_SLOT cannot be combined with a "
+                "consistent snapshot"
+            )
+    conn = acquire_connection(db_params, snapshot)
+    if is_error_response(conn):
+        return conn
+    try:
+        if options["cdc_slot"]:
+            if selection:
+                return handle_error(
+                    "Invalid selection: change exports cannot be narrowed"
+                )
+            return export_changes(conn, staging, file_name, path, options)
+
+        if selection:
+            sql_query = apply_selection(conn, sql_query, selection, options)
+            if is_error_response(sql_query):
+                return sql_query
+
+        fingerprint = None
+        if options["result_cache"]:
+            cache_location = cache_state_location(path, file_name)
+            fingerprint = query_fingerprint(conn, sql_query, options)
+            if is_error_response(fingerprint):
+                return fingerprint
+            state = read_json_state(staging, cache_location)
+            if is_error_response(state):
+                return state
+            hit = (
+                state is not None
+                and state.get("fingerprint") == fingerprint
+                and output_exists(staging, os.path.join(path, file_name))
+            )
+            if report is not None:
+                report["cache"] = "hit" if hit else "miss"
+            if hit:
+                logger.info(f"Result cache hit, keeping {path + file_name}")
+                return state["rows"]
+            logger.info("Result cache miss")
+
+        # Sidecar objects keep the configured name when runs get dated files.
+        base_name = file_name
+        tracker = None
+        if options["watermark_column"]:
+            state_location = watermark_state_location(path, file_name)
+            state = read_json_state(staging, state_location)
+            if is_error_response(state):
+                return state
+            sql_query = apply_watermark(
+                conn, sql_query, options["watermark_column"], state
+            )
+            if is_error_response(sql_query):
+                return sql_query
+            if not options["output_partition_cols"]:
+                # Datasets are appended to (OUTPUT_MODE=append), single files
+                # get a new part.
+                file_name = dated_file_name(file_name)
+            tracker = WatermarkTracker(options["watermark_column"])
+
+        if options["explain_mode"]:
+            diagnostics = explain_query(conn, sql_query, options)
+            if is_error_response(diagnostics):
+                return diagnostics
+            result = write_json_state(
+                staging,
+                plan_state_location(path, base_name),
+                {
+                    "sql": sql_query,
+                    "explained_at": datetime.now(timezone.utc).isoformat(),
+                    **diagnostics,
+                },
+            )
+            if is_error_response(result):
+                return result
+            if report is not None:
+                report["diagnostics"] = diagnostics["summary"]
+
+        if options["checkpoint_column"]:
+            rows = export_resumable(conn, sql_query, staging, file_name, path, options)
+        else:
+            rows = export_query(
+                conn,
+                db_params,
+                sql_query,
+                staging,
+                file_name,
+                path,
+                options,
+                tracker,
+                snapshot,
+            )
+        if is_error_response(rows):
+            return rows
+
+        if options["validate_output"] and (tracker is None or rows):
+            validation = validate_output(
+                conn, sql_query, staging, file_name, path, options, rows, base_name
+            )
+            if is_error_response(validation):
+                return validation
+            if report is not None:
+                report["validation"] = validation
+
+        if tracker is not None and tracker.value is not None:
+            # Only advance the watermark once the new part is written.
+            result = write_json_state(
+                staging, state_location, tracker.state(file_name, rows)
+            )
+            if is_error_response(result):
+                return result
+        if fingerprint is not None:
+            # Markers were read before the export, so changes made while it
+            # ran make the next fingerprint differ.
+            result = write_json_state(
+                staging,
+                cache_location,
+                {
+                    "fingerprint": fingerprint,
+                    "file_name": file_name,
+                    "rows": rows,
+                    "exported_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+            if is_error_response(result):
+                return result
+        return rows
+    finally:
+        release_connection(conn, db_params)
+
+
+def run_export_jobs(event, staging, db_params, path, snapshot=None):
+    """
+    Run the export jobs listed in the invocation event.
+
+    Jobs run in a thread pool bounded by the event's `max_concurrency`, each on
+    its own pooled connection, so queries of some jobs overlap with the
+    uploads of others.
+
+    Args:
+        event (dict): Invocation event with a `jobs` list.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        db_params (tuple): Arguments for `connect_to_db`.
+        path (str): Default storage path for jobs without their own `path`.
+        snapshot (str): Optional snapshot from `export_snapshot` that every
+            job reads.
+
+    Returns:
+        dict: AWS Lambda response with the status and timing of each job.
+    """
+    jobs = event["jobs"]
+    max_concurrency = int(event.get("max_concurrency", DEFAULT_JOB_CONCURRENCY))
+    logger.info(f"Running {len(jobs)} export jobs ({max_concurrency} at a time)...")
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        results = list(
+            executor.map(
+                run_export_job,
+                jobs,
+                itertools.count(),
+                itertools.repeat(staging),
+                itertools.repeat(db_params),
+                itertools.repeat(path),
+                itertools.repeat(snapshot),
+            )
+        )
+    failed = [result["name"] for result in results if result["status"] != "success"]
+    if failed:
+        logger.error(f"Export jobs failed: {', '.join(failed)}")
+    return {
+        "statusCode": 500 if failed else 200,
+        "body": json.dumps({"jobs": results, "metrics": _METRICS.summary()}),
+    }
+
+
+def run_export_job(job, index, staging, db_params, path, snapshot=None):
+    """
+    Run a single job from the invocation event.
+
+    A job has a `file_name`, either inline `sql` or a `sql_file` unless it
+    exports the changes of a replication slot, and optionally
+    a `name`, a `path`, export `options` overriding the environment, and the
+    `columns`, `filters` and `limit` to select.
+
+    Args:
+        job (dict): Job description.
+        index (int): Position of the job in the event, used as a default name.
+        staging (bool): True if the application is in staging mode, False if in production mode.
+        db_params (tuple): Arguments for `connect_to_db`.
+        path (str): Default storage path.
+        snapshot (str): Optional snapshot from `export_snapshot`.
+
+    Returns:
+        dict: Job name, status, rows written or error, result cache status,
+        plan summary and validation when enabled, and duration in seconds.
+    """
+    name = job.get("name", f"job-{index}") if isinstance(job, dict) else f"job-{index}"
+    start = time.perf_counter()
+    report = {}
+    logger.info(f"Starting export job {name}...")
+    try:
+        file_name = job["file_name"]
+        options = load_export_options(job.get("options"))
+        if is_error_response(options):
+            result = options
+        else:
+            if "sql" in job and "sql_file" in job:
+                raise ValueError("only one of 'sql' or 'sql_file' can be given")
+            if "sql" in job:
+                sql_query = job["sql"]
+            elif "sql_file" in job:
+                sql_query = read_sql_query_from_file(job["sql_file"])
+            elif options["cdc_slot"]:
+                sql_query = None
+            else:
+                raise ValueError("exactly one of 'sql' or 'sql_file' is required")
+            result = (
+                sql_query
+                if is_error_response(sql_query)
+                else run_export(
+                    db_params,
+                    sql_query,
+                    staging,
+                    file_name,
+                    job.get("path", path),
+                    options,
+                    report,
+                    event_selection(job),
+                    snapshot,
+                )
+            )
+    except (KeyError, TypeError, ValueError) as e:
+        result = handle_error(f"Invalid export job {name}: {e}")
+
+    seconds = round(time.perf_counter() - start, 3)
+    if is_error_response(result):
+        return {
+            "name": name,
+            "status": "error",
+            "error": result["body"],
+            "seconds": seconds,
+        }
+    logger.info(f"Export job {name} complete ({result} rows in {seconds} s)")
+    return {
+        "name": name,
+        "status": "success",
+        "rows": result,
+        **report,
+        "seconds": seconds,
+    }
+
+
+def lambda_handler(event, context):
+    """
+    AWS Lambda entry point.
+
+    When the event carries a `jobs` list each job is exported, otherwise the
+    query in `query.sql` is exported to `FILE_NAME`, narrowed to the event's
+    `columns`, `filters` and `limit`, if any. With `consistent_snapshot` set
+    to true, every export and partition reads the same snapshot of the
+    database. The wall time, rows, bytes and peak memory of each stage are
+    emitted as structured metrics and summarized in the response body. Batch
+    exports stop cleanly before the timeout given by the context.
+
+    Args:
+        event: AWS Lambda event.
+        context: AWS Lambda context.
+
+    Returns:
+        dict: AWS Lambda response.
+    """
+    logger.info("Starting Postgres2Parquet Lambda Function...")
+    _METRICS.reset()
+    set_deadline(context)
+    try:
+        return _handle_event(event)
+    finally:
+        _METRICS.emit()
+
+
+def _handle_event(event):
+    """Run the exports of one invocation and build the AWS Lambda response."""
+    try:
+        staging = get_environment()
+        (
+            db_name,
+            db_user,
+            db_password,
+            db_host,
+            db_port,
+            file_name,
+            path,
+        ) = load_environment_variables(staging)
+        db_params = (db_name, db_user, db_password, db_host, db_port)
+
+        coordinator = snapshot = None
+        consistent = isinstance(event, dict) and event.get("consistent_snapshot")
+        if str(consistent).strip().lower() == "true":
+            coordinator = export_snapshot(db_params)
+            if is_error_response(coordinator):
+                return coordinator
+            coordinator, snapshot = coordinator
+        try:
+            if isinstance(event, dict) and event.get("jobs"):
+                response = run_export_jobs(event, staging, db_params, path, snapshot)
+                logger.info("Postgres2Parquet Lambda Function complete")
+                return response
+
+            options = load_export_options()
+            if is_error_response(options):
+                return options
+            sql_query = read_sql_query_from_file("query.sql")
+            if is_error_response(sql_query):
+                return sql_query
+            report = {}
+            selection = event_selection(event) if isinstance(event, dict) else None
+            result = run_export(
+                db_params,
+                sql_query,
+                staging,
+                file_name,
+                path,
+                options,
+                report,
+                selection,
+                snapshot,
             )
-            write_to_s3_or_local(query_result, staging, file_name, path)
+            if is_error_response(result):
+                return result
         finally:
-            conn.close()
-            logger.info("DB connection closed")
+            # Closing the coordinator transaction ends the snapshot.
+            release_connection(coordinator, db_params)
 
         logger.info("Postgres2Parquet Lambda Function complete")
-        return {"statusCode": 200, "body": json.dumps("Success")}
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    "status": "Success",
+                    "rows": result,
+                    **report,
+                    "metrics": _METRICS.summary(),
+                }
+            ),
+        }
 
     except Exception as e:
         return handle_error(f"Lambda handler error: {e}")